@@ -0,0 +1,100 @@
+"""Benchmark of the upstream requests made by the abyss command
+
+genshinstats is replaced by a fake with a fixed latency which counts its calls, C commands for U uids are
+ran at the same time like popular uids being looked up in several channels.
+
+>>> python benchmarks/genshin_abyss.py --commands 50 --uids 5 --latency 0.3
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import *  # type: ignore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import genshinstats as gs
+
+from utils.hoyolab import HoyolabClient
+from utils.tools import to_thread
+
+
+class FakeEndpoint:
+    """Stand-in for gs.get_spiral_abyss which sleeps for the latency and counts its calls"""
+    __name__ = 'get_spiral_abyss'
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter[tuple[int, bool]] = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, uid: int, previous: bool = False, **kwargs: Any) -> dict[str, Any]:
+        with self.lock:
+            self.calls[uid, previous] += 1
+        time.sleep(self.latency)
+        return {'season': 1 - previous, 'stats': {'total_battles': 0}, 'floors': [], 'character_ranks': {}}
+
+
+async def legacy_command(uid: int) -> None:
+    """Requests made by the abyss command before the client, one ignored and one per season"""
+    await to_thread(gs.get_spiral_abyss, uid)
+    await to_thread(gs.get_spiral_abyss, uid, True)
+    await to_thread(gs.get_spiral_abyss, uid, False)
+
+
+async def client_command(client: HoyolabClient, uid: int) -> None:
+    """Requests made by the abyss command through the client"""
+    await client.get_abyss_seasons(uid)
+
+
+async def run(args: argparse.Namespace, legacy: bool) -> dict[str, Any]:
+    """Run the commands at the same time and return the call counts and latencies"""
+    endpoint = gs.get_spiral_abyss = FakeEndpoint(args.latency)
+    client = HoyolabClient(max_workers=args.workers)
+    uids = [700000000 + i for i in range(args.uids)]
+
+    latencies = []
+
+    async def command(uid: int) -> None:
+        start = time.perf_counter()
+        if legacy:
+            await legacy_command(uid)
+        else:
+            await client_command(client, uid)
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(command(uids[i % len(uids)]) for i in range(args.commands)))
+    client.close()
+    latencies.sort()
+    calls = sum(endpoint.calls.values())
+    return {
+        'path': 'legacy' if legacy else 'client',
+        'commands': args.commands,
+        'upstream_calls': calls,
+        'calls_per_command': calls / args.commands,
+        'p50_latency': latencies[len(latencies) // 2],
+        'max_latency': latencies[-1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=50, help="abyss commands ran at the same time")
+    parser.add_argument('--uids', type=int, default=5, help="distinct uids looked up by the commands")
+    parser.add_argument('--latency', type=float, default=0.3, help="seconds every upstream call takes")
+    parser.add_argument('--workers', type=int, default=4, help="threads of the client's executor")
+    args = parser.parse_args()
+
+    for legacy in (True, False):
+        results = asyncio.run(run(args, legacy))
+        print(', '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Benchmark of the HoYoLAB request scheduler against a rate limited fake endpoint
+
+genshinstats is replaced by a fake which allows `rate` requests a second per cookie like mihoyo does and raises
+TooManyRequests above it. A burst of background refreshes is queued together with interactive commands.
+With several accounts the scheduled requests are spread over a cookie pool.
+
+>>> python benchmarks/hoyolab_ratelimit.py --commands 20 --refreshes 40 --rate 5 --accounts 2
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import *  # type: ignore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import genshinstats as gs
+
+from utils.hoyolab import CookiePool, HoyolabClient
+from utils.ratelimit import BACKGROUND, RequestScheduler, TokenBucket
+
+
+class FakeEndpoint:
+    """Stand-in for gs.get_user_stats which rate limits every cookie"""
+    __name__ = 'get_user_stats'
+
+    def __init__(self, rate: float, latency: float):
+        self.rate = rate
+        self.buckets: dict[str, TokenBucket] = {}
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, uid: int, cookie: dict[str, str] = None, **kwargs: Any) -> dict[str, Any]:
+        name = (cookie or {}).get('ltuid', '')
+        with self.lock:
+            bucket = self.buckets.setdefault(name, TokenBucket(self.rate, self.rate))
+            limited = bucket.delay() > 0
+            if not limited:
+                bucket.take()
+            self.calls['limited' if limited else 'ok'] += 1
+        time.sleep(self.latency)
+        if limited:
+            raise gs.TooManyRequests("Too many requests")
+        return {'stats': {}, 'explorations': [], 'teapots': [], 'characters': []}
+
+
+async def run(args: argparse.Namespace, scheduled: bool) -> dict[str, Any]:
+    """Queue the refreshes and commands at the same time and return the errors and latencies"""
+    endpoint = gs.get_user_stats = FakeEndpoint(args.rate, args.latency)
+    if not scheduled:
+        client = HoyolabClient(max_workers=args.workers)
+    elif args.accounts > 1:
+        cookies = [{'ltuid': str(i), 'ltoken': 'fake'} for i in range(args.accounts)]
+        client = HoyolabClient(max_workers=args.workers, pool=CookiePool(cookies, args.rate, args.rate, cooldown=1))
+    else:
+        client = HoyolabClient(max_workers=args.workers, scheduler=RequestScheduler(args.rate, args.rate))
+
+    latencies: dict[str, list[float]] = {'interactive': [], 'background': []}
+    errors: Counter[str] = Counter()
+
+    async def request(uid: int, kind: str) -> None:
+        start = time.perf_counter()
+        try:
+            if kind == 'background':
+                await client.call(gs.get_user_stats, uid, priority=BACKGROUND)
+            else:
+                await client.call(gs.get_user_stats, uid)
+        except gs.GenshinStatsException:
+            errors[kind] += 1
+        else:
+            latencies[kind].append(time.perf_counter() - start)
+
+    async def commands() -> None:
+        # NOTE: commands trickle in after the refreshes were queued like users would
+        tasks = []
+        for i in range(args.commands):
+            tasks.append(asyncio.ensure_future(request(800000000 + i, 'interactive')))
+            await asyncio.sleep(args.interval)
+        await asyncio.gather(*tasks)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(700000000 + i, 'background') for i in range(args.refreshes)), commands())
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    results: dict[str, Any] = {'path': f'scheduled x{args.accounts}' if scheduled else 'direct'}
+    for kind, values in latencies.items():
+        values.sort()
+        results[f'{kind}_errors'] = errors[kind]
+        results[f'{kind}_p50'] = values[len(values) // 2] if values else 0
+        results[f'{kind}_max'] = values[-1] if values else 0
+    results['upstream_limited'] = endpoint.calls['limited']
+    results['throughput'] = endpoint.calls['ok'] / elapsed
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=20, help="interactive commands")
+    parser.add_argument('--refreshes', type=int, default=40, help="background refreshes queued at the start")
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between commands")
+    parser.add_argument('--rate', type=float, default=5, help="requests per second allowed by the fake endpoint")
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds every upstream call takes")
+    parser.add_argument('--workers', type=int, default=8, help="threads of the client's executor")
+    parser.add_argument('--accounts', type=int, default=1, help="cookies in the pool of the scheduled run")
+    args = parser.parse_args()
+
+    for scheduled in (False, True):
+        results = asyncio.run(run(args, scheduled))
+        print(', '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""Benchmark of the music pipeline with local stand-ins for discord and youtube
+
+N guilds each queue M tracks which are served by a local http server, the audio is read by a fake
+voice client at `--speed` times realtime instead of being sent to discord.
+
+>>> python benchmarks/music_pipeline.py --guilds 8 --tracks 4 --mode stream --codec opus
+>>> python benchmarks/music_pipeline.py --guilds 8 --tracks 4 --mode download --no-prefetch --json results.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import functools
+import gc
+import http.server
+import itertools
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import *  # type: ignore
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+message_ids = itertools.count(1)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest rank percentile, 0 for no values"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def make_samples(directory: str, count: int, duration: float) -> list[str]:
+    """Generate ogg/opus sine waves with ffmpeg, every sample has its own pitch
+
+    The duration is part of the file name so samples of a previous run are only reused if they're as long.
+    """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for i in range(count):
+        name = f"track-{i:03}-{duration:g}s.ogg"
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            subprocess.run(
+                ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency={220 + 20 * i}:duration={duration}',
+                 '-c:a', 'libopus', '-b:a', '96k', path],
+                check=True)
+        names.append(name)
+    return names
+
+
+def serve(directory: str) -> http.server.ThreadingHTTPServer:
+    """Serve the samples on a random local port in a background thread"""
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeUser:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = self.display_name = f"user{id}"
+        self.avatar_url = None
+
+
+class FakeMessage:
+    def __init__(self, id: int = None):
+        self.id = id or next(message_ids)
+
+    async def add_reaction(self, emoji: str) -> None:
+        pass
+
+    async def delete(self) -> None:
+        pass
+
+
+class FakeChannel:
+    def __init__(self, id: int):
+        self.id = id
+
+    async def send(self, *args: Any, **kwargs: Any) -> FakeMessage:
+        return FakeMessage()
+
+    def get_partial_message(self, id: int) -> FakeMessage:
+        return FakeMessage(id)
+
+
+class FakeVoiceClient:
+    """Stand-in for discord.VoiceClient which reads the audio like discord.py's AudioPlayer but doesn't send it
+
+    `after` is called on the event loop instead of the player thread so the loop wakes up right away.
+    """
+    def __init__(self, guild: FakeGuild, channel: FakeChannel, loop: asyncio.AbstractEventLoop, speed: float):
+        self.guild = guild
+        self.channel = channel
+        self.loop = loop
+        self.speed = speed
+        self._source = None
+        self._thread: Optional[threading.Thread] = None
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self.records: list[dict[str, Any]] = []
+
+    @property
+    def source(self) -> Any:
+        return self._source
+
+    @source.setter
+    def source(self, value: Any) -> None:
+        if self._thread is None:
+            raise ValueError("Not playing anything.")
+        self._source = value
+
+    def play(self, source: Any, *, after: Callable[[Optional[Exception]], Any] = None) -> None:
+        if self.is_playing():
+            raise RuntimeError("Already playing audio.")
+
+        self._source = source
+        self._end = threading.Event()
+        self._resumed.set()
+        record = {'first': None, 'last': None, 'frames': 0}
+        self.records.append(record)
+        self._thread = threading.Thread(target=self._run, args=(self._end, after, record), daemon=True)
+        self._thread.start()
+
+    def _run(self, end: threading.Event, after: Optional[Callable[..., Any]], record: dict[str, Any]) -> None:
+        error = None
+        delay = 0.02 / self.speed
+        start, loops = time.perf_counter(), 0
+        try:
+            while not end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    start, loops = time.perf_counter(), 0
+                    continue
+
+                data = self._source.read()
+                if not data:
+                    break
+
+                now = time.perf_counter()
+                record['first'] = record['first'] or now
+                record['last'] = now
+                record['frames'] += 1
+                loops += 1
+                time.sleep(max(0, start + delay * loops - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            self._source.cleanup()
+            end.set()
+            if after is not None:
+                self.loop.call_soon_threadsafe(after, error)
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and not self._end.is_set() and self._resumed.is_set()
+
+    def is_paused(self) -> bool:
+        return self._thread is not None and not self._end.is_set() and not self._resumed.is_set()
+
+    def pause(self) -> None:
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        self._resumed.set()
+
+    def stop(self) -> None:
+        self._end.set()
+        self._resumed.set()
+
+    async def disconnect(self) -> None:
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeGuild:
+    def __init__(self, id: int):
+        self.id = id
+        self.voice_client: Optional[FakeVoiceClient] = None
+        self.filesize_limit = 8 * 1024**2
+
+    def get_member(self, id: int) -> None:
+        return None
+
+
+class FakeContext:
+    """The parts of commands.Context used by the music commands"""
+    def __init__(self, guild: FakeGuild, channel: FakeChannel, author: FakeUser):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage()
+
+    @property
+    def voice_client(self) -> Optional[FakeVoiceClient]:
+        return self.guild.voice_client
+
+    async def send(self, *args: Any, **kwargs: Any) -> FakeMessage:
+        return FakeMessage()
+
+
+class FakeBot:
+    """The parts of commands.Bot used by the music cog"""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.user = FakeUser(0)
+        self.guilds: dict[int, FakeGuild] = {}
+        self.channels: dict[int, FakeChannel] = {}
+
+    async def wait_until_ready(self) -> None:
+        pass
+
+    def get_guild(self, id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(id)
+
+    def get_channel(self, id: int) -> Optional[FakeChannel]:
+        return self.channels.get(id)
+
+    @property
+    def voice_clients(self) -> list[FakeVoiceClient]:
+        return [guild.voice_client for guild in self.guilds.values() if guild.voice_client is not None]
+
+
+def rusage_cpu() -> float:
+    """CPU seconds used by the process and its waited for children (FFmpeg)"""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+async def run(args: argparse.Namespace, base_url: str) -> dict[str, Any]:
+    """Drive the music cog and return the measurements"""
+    from cogs import music
+
+    loop = asyncio.get_running_loop()
+    bot = FakeBot(loop)
+    process = psutil.Process()
+    gc.collect()
+    rss_before = process.memory_info().rss
+    cpu_before = rusage_cpu()
+
+    cog = music.MusicPlayer(bot)
+    if args.no_prefetch:
+        cog.schedule_prefetch = lambda guild_id: None
+
+    samples = len(args.sample_names)
+    guilds = []
+    for g in range(args.guilds):
+        guild = FakeGuild(1000 + g)
+        channel = FakeChannel(2000 + g)
+        bot.guilds[guild.id] = guild
+        bot.channels[channel.id] = channel
+        guild.voice_client = FakeVoiceClient(guild, FakeChannel(3000 + g), loop, args.speed)
+        guilds.append((guild, FakeContext(guild, channel, FakeUser(4000 + g))))
+
+    async def drive(guild: FakeGuild, ctx: FakeContext) -> float:
+        """Queue the tracks of a guild like users would, returns when the first song was requested"""
+        urls = [f"{base_url}/{args.sample_names[((guild.id - 1000) * args.tracks + m) % samples]}" for m in range(args.tracks)]
+        requested = time.perf_counter()
+        await cog.play.callback(cog, ctx, song=urls[0])
+        for url in urls[1:]:
+            await cog.play.callback(cog, ctx, song=url)
+        return requested
+
+    started = time.perf_counter()
+    requested = await asyncio.gather(*(drive(guild, ctx) for guild, ctx in guilds))
+
+    # NOTE: wait until every guild played all its tracks
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        if all(
+            guild.voice_client is not None and not guild.voice_client.is_playing() and guild.id in cog.player
+            and not cog.player[guild.id].queue and len(guild.voice_client.records) >= args.tracks
+            for guild, ctx in guilds
+        ):
+            break
+        await asyncio.sleep(0.05)
+    else:
+        print(f"timed out after {args.timeout}s", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    ttff, gaps, frames = [], [], 0
+    for (guild, ctx), request in zip(guilds, requested):
+        records = [r for r in guild.voice_client.records if r['first'] is not None]
+        frames += sum(r['frames'] for r in records)
+        if records:
+            ttff.append(records[0]['first'] - request)
+        gaps += [b['first'] - a['last'] for a, b in zip(records, records[1:])]
+
+    cpu = rusage_cpu() - cpu_before
+    audio_seconds = frames * 0.02
+
+    for guild, ctx in guilds:
+        await guild.voice_client.disconnect()
+        await cog.release_player(guild.id)
+    await asyncio.sleep(0.5)
+    pins = sum(cog.cache.pins.values()) + sum(cog.converted.pins.values())
+    cog.cog_unload()
+    gc.collect()
+    rss_after = process.memory_info().rss
+
+    leftovers = [
+        os.path.join(root, name)
+        for directory, cache in ((args.cache_dir, cog.cache), (args.downloads_dir, cog.converted))
+        for root, dirs, files in os.walk(directory)
+        for name in files
+        if name not in cache.entries and name != 'index.json'
+    ]
+    return {
+        'guilds': args.guilds, 'tracks': args.tracks, 'samples': samples, 'duration': args.duration, 'speed': args.speed,
+        'mode': args.mode, 'codec': args.codec, 'prefetch': not args.no_prefetch,
+        'elapsed': elapsed,
+        'ttff_p50': percentile(ttff, 50), 'ttff_p99': percentile(ttff, 99),
+        'gap_p50': percentile(gaps, 50), 'gap_p99': percentile(gaps, 99),
+        'cpu_per_stream': cpu / audio_seconds if audio_seconds else 0,
+        'audio_seconds': audio_seconds,
+        'rss_growth_mb': (rss_after - rss_before) / 1024**2,
+        'leftover_files': len(leftovers), 'leaked_pins': pins,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=4)
+    parser.add_argument('--tracks', type=int, default=3, help="tracks queued by every guild")
+    parser.add_argument('--samples', type=int, default=0, help="distinct songs, fewer than guilds * tracks makes guilds share songs")
+    parser.add_argument('--duration', type=float, default=10, help="length of every song in seconds")
+    parser.add_argument('--speed', type=float, default=10, help="how many times faster than realtime the audio is read")
+    parser.add_argument('--mode', choices=('stream', 'download'), default='stream')
+    parser.add_argument('--codec', choices=('opus', 'pcm'), default='opus')
+    parser.add_argument('--no-prefetch', action='store_true')
+    parser.add_argument('--warm', action='store_true', help="keep the audio cache of the previous run in the work directory")
+    parser.add_argument('--cache-streams', type=int, default=2, help="streamed plays after which a song is cached, 0 never caches")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'music-benchmark'))
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', help="append the results as a json line to this file")
+    args = parser.parse_args()
+
+    samples = args.samples or args.guilds * args.tracks
+    os.makedirs(args.workdir, exist_ok=True)
+    sample_dir = os.path.join(args.workdir, 'samples')
+    args.sample_names = make_samples(sample_dir, samples, args.duration)
+
+    args.cache_dir = os.path.join(args.workdir, 'audio_cache')
+    args.downloads_dir = os.path.join(args.workdir, 'downloads')
+    if not args.warm:
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+        shutil.rmtree(args.downloads_dir, ignore_errors=True)
+    for name in ('music_queues.json', 'music_queues.json.tmp'):
+        if os.path.isfile(os.path.join(args.workdir, name)):
+            os.remove(os.path.join(args.workdir, name))
+
+    # NOTE: the music cog reads config.json from the working directory when it's imported,
+    # utils.permissions also reads the owners then
+    with open(os.path.join(args.workdir, 'config.json'), 'w') as file:
+        json.dump({
+            'owners': [],
+            'yt_apikey': '',
+            'music_stream': args.mode == 'stream',
+            'music_opus': args.codec == 'opus',
+            'music_cache_streams': args.cache_streams,
+            'music_cache_dir': args.cache_dir,
+            'music_downloads_dir': args.downloads_dir,
+            'music_min_free_space': 0,
+            'music_snapshot_file': os.path.join(args.workdir, 'music_queues.json'),
+        }, file)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    os.chdir(args.workdir)
+
+    server = serve(sample_dir)
+    try:
+        results = asyncio.run(run(args, f"http://127.0.0.1:{server.server_address[1]}"))
+    finally:
+        server.shutdown()
+
+    for key, value in results.items():
+        print(f"{key:>16}: {value:.3f}" if isinstance(value, float) else f"{key:>16}: {value}")
+
+    if args.json:
+        with open(args.json, 'a') as file:
+            file.write(json.dumps(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,15 @@ import os
 import sys
 import json
 
-from cachetools import TTLCache
 from discord.ext import commands
 from discord_slash import cog_ext, SlashContext
 from psutil import users
-from utils import permissions, http, grouper, send_pages, to_thread, default
-from typing import Any, Optional, TypeVar, Union , Dict
+from utils import permissions, http, grouper, send_pages, default, wrap
+from utils.emojis import emoji_index
+from utils.hoyolab import HoyolabClient, load_cookies
+from utils.tieredcache import TieredCache
+from typing import Any, Awaitable, Callable, Iterator, Optional, TypeVar, Union , Dict
+from itertools import chain
 from datetime import datetime, timedelta
 
 
@@ -47,25 +50,40 @@ class GenshinImpact(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        gs.set_cookies(config['cookie_file'])
-        self.cache = TTLCache(1024, 3600)
-        gs.install_cache(self.cache)
+        # NOTE: responses are kept in memory and in sqlite so restarts and reloads don't start with a cold cache
+        self.cache = TieredCache(config.get('genshin_cache_file', 'genshin_cache.db'), config.get('genshin_cache_size', 4096))
+        # NOTE: every cookie is rate limited by mihoyo as a whole so each account gets its own scheduler,
+        # without any cookies configured requests are made without an account and succeed or fail on their own
+        # NOTE: every mihoyo request goes through the client so a slow response never blocks the bot
+        self.client = HoyolabClient.from_cookies(
+            load_cookies(config.get('genshin_cookies') or [config.get('cookie_file', '')]),
+            config.get('genshin_rate', 1), config.get('genshin_burst', 5), config.get('genshin_cookie_cooldown', 3600),
+            max_workers=config.get('genshin_workers', 4), timeout=config.get('genshin_timeout', 15), cache=self.cache,
+            ttls=config.get('genshin_cache_ttls', {}), stale=config.get('genshin_cache_stale', 86400),
+            notice_interval=config.get('genshin_notice_interval', 60)
+        )
+
+    def cog_unload(self):
+        self.client.close()
 
-    def _element_emoji(self, element: str) -> discord.Emoji:
+    def _element_emoji(self, element: str) -> Optional[discord.Emoji]:
+        """Returns the emoji of an element from the main server."""
         g = self.bot.get_guild(570841314200125460) or self.bot.guilds[0]
-        e = discord.utils.get(g.emojis, name=element.lower())
-        try:
-            assert e
-            return e
-    # many more statements like this
-        except AssertionError:
-            return e
+        return emoji_index.get(g, element)
 
     async def _user_uid(self, ctx: commands.Context, user: Union[discord.User, discord.Member, int, None]) -> int:
         """Helper function to either get the uid or raise an error"""
         if isinstance(user, int):
             return user
 
+    def _queue_notice(self, ctx: commands.Context) -> Callable[[int], Awaitable[None]]:
+        """Returns a callback which tells the user their position when mihoyo requests are queued.
+
+        During an outage every channel only gets a notice every `genshin_notice_interval` seconds.
+        """
+        async def notify(position: int) -> None:
+            await ctx.send(f"HoYoLAB is busy, you're #{position} in the queue...")
+        return self.client.notice(ctx.channel.id, notify)
     
 
     @commands.group(invoke_without_command=True, aliases=['gs', 'gistats', 'player'])
@@ -76,16 +94,15 @@ class GenshinImpact(commands.Cog):
 
         await ctx.trigger_typing()
         try:
-            data = await to_thread(gs.get_user_stats, uid)
+            data = await self.client.get_user_stats(uid, notify=self._queue_notice(ctx))
         except gs.GenshinStatsException as e:
             await ctx.send(e.msg)
             return
         
-        await ctx.trigger_typing()
+        await send_pages(ctx, ctx, self._playerstats_pages(uid, data))
 
-        getdata = data["stats"]
-        pages = []
-        
+    def _playerstats_pages(self, uid: int, data: dict) -> Iterator[discord.Embed]:
+        """Renders the pages of playerstats once they're viewed."""
         stats_embed = discord.Embed(
             colour=0xffffff,
             title=f"Info about {uid}",
@@ -99,7 +116,7 @@ class GenshinImpact(commands.Cog):
                 name=field.replace('_', ' '),
                 value=value
             )
-        pages.append(stats_embed)
+        yield stats_embed
 
         exploration_embed = discord.Embed(
             colour=0xffffff,
@@ -125,7 +142,7 @@ class GenshinImpact(commands.Cog):
                       f"Unlocked styles: {', '.join(i['name'] for i in data['teapots'])}"
             )
         
-        pages.append(exploration_embed)
+        yield exploration_embed
 
         character_embed = discord.Embed(
             colour=0xffffff,
@@ -143,96 +160,35 @@ class GenshinImpact(commands.Cog):
                     name=f"{char['name']}",
                     value=f"{'★'*char['rarity']} {char['element']}\nlvl {char['level']}, friendship {char['friendship']}"
                 )
-            pages.append(embed)
-
-        await send_pages(ctx, ctx, pages)
-
-    async def _genshin_abyss_new(self, uid: int) -> discord.Embed:
-        """Gets the embeds for spiral abyss history for a specific season."""
-        data = gs.get_spiral_abyss(uid, True)
-        if data['stats']['total_battles'] == 0:
-            return []
-
-        star = self._element_emoji('abyss_star')
-        embeds = [
-            discord.Embed(
-                colour=0xffffff,
-                title=f"Spiral abyss info of {uid}",
-                description="Overall spiral abyss stats"
-            ).add_field(
-                name="Stats",
-                value=f"Max floor: {data['stats']['max_floor']} Total stars: {data['stats']['total_stars']}\n"
-                      f"Total battles: {data['stats']['total_battles']} Total wins: {data['stats']['total_wins']}",
-                inline=False
-            ).add_field(
-                name="Character ranks",
-                value="\n".join(f"**{k.replace('_',' ')}**: " + ', '.join(f"{i['name']} ({i['value']})" for i in v[:4]) for k,v in data['character_ranks'].items() if v) or "avalible only for floor 9 or above",
-                inline=False
-            ).set_author(
-                name=f"Season {data['season']} ({data['season_start_time'].replace('-', '/')} - {data['season_end_time'].replace('-', '/')})\n"
-            ).set_footer(
-                text="Powered by genshinstats",
-                icon_url=GENSHIN_LOGO
-            ).set_image(
-                url=abyss_banners[0]
-            )
-        ]
-        for floor in data['floors']:
-            embed = discord.Embed(
-                colour=0xffffff,
-                title=f"Spiral abyss info of {uid}",
-                description=f"Floor **{floor['floor']}** (**{floor['stars']}**{star})",
-                timestamp=datetime.fromisoformat(floor['start'])
-            ).set_author(
-                name=f"Season {data['season']} ({data['season_start_time'].replace('-', '/')} - {data['season_end_time'].replace('-', '/')})\n"
-            ).set_footer(
-                text="Powered by genshinstats",
-                icon_url=GENSHIN_LOGO
-            ).set_image(
-                url=abyss_banners.get(floor['floor'], discord.Embed.Empty)
-            )
-            for chamber in floor['chambers']:
-                for battle in chamber['battles']:
-                    embed.add_field(
-                        name=f"Chamber {chamber['chamber']}" + (f"{', 1st' if battle['half']==1 else ', 2nd'} Half " if chamber['has_halves'] else '') + f" ({chamber['stars']}{star})",
-                        value='\n'.join(f"{i['name']} (lvl {i['level']})" for i in battle['characters']),
-                        inline=True
-                    )
-                    if battle['half'] == 2:
-                        embed.add_field(name='\u200b', value='\u200b')
-            embeds.append(embed)
-        return embeds
+            yield embed
 
-    async def _genshin_abyss_ago(self, uid: int) -> discord.Embed:
-        """Gets the embeds for spiral abyss history for a specific season."""
-        data = gs.get_spiral_abyss(uid, False)
+    def _genshin_abyss(self, uid: int, data: dict) -> Iterator[discord.Embed]:
+        """Renders the embeds for spiral abyss history for a specific season once they're viewed."""
         if data['stats']['total_battles'] == 0:
-            return []
+            return
 
         star = self._element_emoji('abyss_star')
-        embeds = [
-            discord.Embed(
-                colour=0xffffff,
-                title=f"Spiral abyss info of {uid}",
-                description="Overall spiral abyss stats"
-            ).add_field(
-                name="Stats",
-                value=f"Max floor: {data['stats']['max_floor']} Total stars: {data['stats']['total_stars']}\n"
-                      f"Total battles: {data['stats']['total_battles']} Total wins: {data['stats']['total_wins']}",
-                inline=False
-            ).add_field(
-                name="Character ranks",
-                value="\n".join(f"**{k.replace('_',' ')}**: " + ', '.join(f"{i['name']} ({i['value']})" for i in v[:4]) for k,v in data['character_ranks'].items() if v) or "avalible only for floor 9 or above",
-                inline=False
-            ).set_author(
-                name=f"Season {data['season']} ({data['season_start_time'].replace('-', '/')} - {data['season_end_time'].replace('-', '/')})\n"
-            ).set_footer(
-                text="Powered by genshinstats",
-                icon_url=GENSHIN_LOGO
-            ).set_image(
-                url=abyss_banners[0]
-            )
-        ]
+        yield discord.Embed(
+            colour=0xffffff,
+            title=f"Spiral abyss info of {uid}",
+            description="Overall spiral abyss stats"
+        ).add_field(
+            name="Stats",
+            value=f"Max floor: {data['stats']['max_floor']} Total stars: {data['stats']['total_stars']}\n"
+                  f"Total battles: {data['stats']['total_battles']} Total wins: {data['stats']['total_wins']}",
+            inline=False
+        ).add_field(
+            name="Character ranks",
+            value="\n".join(f"**{k.replace('_',' ')}**: " + ', '.join(f"{i['name']} ({i['value']})" for i in v[:4]) for k,v in data['character_ranks'].items() if v) or "avalible only for floor 9 or above",
+            inline=False
+        ).set_author(
+            name=f"Season {data['season']} ({data['season_start_time'].replace('-', '/')} - {data['season_end_time'].replace('-', '/')})\n"
+        ).set_footer(
+            text="Powered by genshinstats",
+            icon_url=GENSHIN_LOGO
+        ).set_image(
+            url=abyss_banners[0]
+        )
         for floor in data['floors']:
             embed = discord.Embed(
                 colour=0xffffff,
@@ -256,78 +212,96 @@ class GenshinImpact(commands.Cog):
                     )
                     if battle['half'] == 2:
                         embed.add_field(name='\u200b', value='\u200b')
-            embeds.append(embed)
-        return embeds
-
+            yield embed
 
     @commands.group(invoke_without_command=True, aliases=['ga', 'giabyss', 'spiral'])
     @commands.cooldown(5, 60, commands.BucketType.user)
     async def abyss(self, ctx: commands.Context, usr: int):
         """Shows info about a genshin player's spiral abyss runs"""
         uid = await self._user_uid(ctx, usr)
-        spiral_abyss = gs.get_spiral_abyss(uid)
 
         await ctx.trigger_typing()
-        embeds = []
         try:
-            embeds += await self._genshin_abyss_new(uid)
-            embeds += await self._genshin_abyss_ago(uid)
+            # NOTE: both seasons are fetched at once and shared with other channels asking for the same uid
+            current, previous = await self.client.get_abyss_seasons(uid, notify=self._queue_notice(ctx))
         except gs.GenshinStatsException as e:
             await ctx.send(e.msg)
             return
-        if not embeds:
+        if previous['stats']['total_battles'] == 0 and current['stats']['total_battles'] == 0:
             await ctx.send("Player hasn't done any spiral abyss in the past month")
             return
         
-        await send_pages(ctx, ctx, embeds)
+        await send_pages(ctx, ctx, chain(self._genshin_abyss(uid, previous), self._genshin_abyss(uid, current)))
 
     @commands.group(invoke_without_command=True, aliases=['gc', 'gichara', 'chara'])
     @commands.cooldown(5, 60, commands.BucketType.user)
     async def characters(self, ctx: commands.Context, usr: int, lang: str = 'en-us'):
         """Shows info about a genshin player's characters"""
         uid = await self._user_uid(ctx, usr)
-        langs = gs.get_langs()
         icon_cache: dict[int, str] = {}
+        try:
+            langs = await self.client.get_langs()
+        except gs.GenshinStatsException as e:
+            await ctx.send(e.msg)
+            return
         if lang not in langs:
             raise commands.UserInputError("Invalid lang, must be one of: " + ', '.join(langs.keys()))
         
         await ctx.trigger_typing()
         try:
-            data = gs.get_characters(uid)
+            data = await self.client.get_characters(uid, lang, notify=self._queue_notice(ctx))
         except gs.GenshinStatsException as e:
             await ctx.send(e.msg)
             return
         for char in data:
             icon_cache[char['weapon']['name']] = char['weapon']['icon']
+        if not data:
+            await ctx.send("Player doesn't have any characters")
+            return
         
-        embeds = [
-            discord.Embed(
-                colour=_item_color(char['rarity']),
-                title=char['name'],
-                description=f"{'★'*char['rarity']} {char['element']} "
-                            f"level {char['level']} C{char['constellation']}"
-            ).set_thumbnail(
-                url=char['weapon']['icon']
-            ).set_image(
-                url=char['image']
-            ).add_field(
-                name=f"Weapon",
-                value=f"{'★'*char['weapon']['rarity']} {char['weapon']['type']} - {char['weapon']['name']}\n"
-                      f"level {char['weapon']['level']} refinement {char['weapon']['refinement']}",
-                inline=False
-            ).add_field(
-                name=f"Artifacts",
-                value="\n".join(f"**{(i['pos_name'].title()+':')}** {i['set']['name']}\n{'★'*i['rarity']} lvl {i['level']} - {i['name']}" for i in char['artifacts']) or 'none equipped',
-                inline=False
-            ).set_footer(
-                text="Powered by genshinstats",
-                icon_url=GENSHIN_LOGO
-            )
-            for char in data
-        ]
-        await send_pages(ctx, ctx, embeds)
+        await send_pages(ctx, ctx, (self._character_embed(char) for char in data))
+
+    def _character_embed(self, char: dict) -> discord.Embed:
+        """Renders the page of a single character."""
+        return discord.Embed(
+            colour=_item_color(char['rarity']),
+            title=char['name'],
+            description=f"{'★'*char['rarity']} {char['element']} "
+                        f"level {char['level']} C{char['constellation']}"
+        ).set_thumbnail(
+            url=char['weapon']['icon']
+        ).set_image(
+            url=char['image']
+        ).add_field(
+            name=f"Weapon",
+            value=f"{'★'*char['weapon']['rarity']} {char['weapon']['type']} - {char['weapon']['name']}\n"
+                  f"level {char['weapon']['level']} refinement {char['weapon']['refinement']}",
+            inline=False
+        ).add_field(
+            name=f"Artifacts",
+            value="\n".join(f"**{(i['pos_name'].title()+':')}** {i['set']['name']}\n{'★'*i['rarity']} lvl {i['level']} - {i['name']}" for i in char['artifacts']) or 'none equipped',
+            inline=False
+        ).set_footer(
+            text="Powered by genshinstats",
+            icon_url=GENSHIN_LOGO
+        )
 
-        pass
+    @commands.command(name='genshin-cache')
+    @commands.check(permissions.is_owner)
+    async def genshin_cache(self, ctx: commands.Context):
+        """Shows the hit rates of the genshin cache and the requests made to mihoyo by every account"""
+        stats = self.client.stats()
+        served = sum(stats['served'].values()) or 1
+        lines = [
+            *(f"{tier}: {hits} lookups ({rate:.1%})\n" for tier, (hits, rate) in stats['tiers'].items()),
+            *(f"{kind}: {count} ({count / served:.1%})\n" for kind, count in stats['served'].items()),
+            *(f"{endpoint}: {count} requests\n" for endpoint, count in stats['requests'].items()),
+            *(f"account {name}: {usage['requests']} requests, {usage['errors']} errors, {usage['waiting']} waiting, "
+              f"{usage['rate']:.2f}/s" + (f", cooldown {usage['cooldown']:.0f}s\n" if usage['cooldown'] else "\n")
+              for name, usage in stats['accounts'].items()),
+            *(f"{key}: {value:.2f}\n" if isinstance(value, float) else f"{key}: {value}\n" for key, value in stats['scheduler'].items()),
+        ]
+        await ctx.send(wrap(*lines) if lines else "No lookups yet")
 
 def setup(bot):
     bot.add_cog(GenshinImpact(bot))
\ No newline at end of file
@@ -1,14 +1,27 @@
 import discord
 import asyncio
 import random
+import re
 import youtube_dl
-import string
 import os
 import sys
 import json
-from discord.ext import commands
-from googleapiclient.discovery import build
+import math
+import subprocess
+import time
+import heapq
+import threading
+from cachetools import TTLCache
+from collections import deque, namedtuple
+from datetime import timedelta
+from itertools import islice
+from discord.ext import commands, tasks
 from discord.ext.commands import command
+from utils import grouper, permissions, send_pages, to_thread, wrap
+from utils.audiocache import AudioCache, cache_key, normalize_query
+from utils.jobs import JobScheduler, SingleFlight
+from utils.settings import GuildSettings
+from utils.youtube import get_client
 
 # import pymongo
 # NOTE: Import pymongo if you are using the database function commands
@@ -17,7 +30,7 @@ from discord.ext.commands import command
 # TODO: CREATE PLAYLIST SUPPORT FOR MUSIC
 
 
-# NOTE: Without database, the music bot will not save your volume
+# NOTE: volume and the other server settings are saved in the sqlite database of `music_settings_file`
 
 
 # flat-playlist:True?
@@ -43,28 +56,21 @@ ytdl_format_options = {
     'source_address': '0.0.0.0'
 }
 
-# Download youtube-dl options
-ytdl_download_format_options = {
-    'format': 'bestaudio/best',
-    'outtmpl': 'downloads/%(title)s.mp3',
-    'reactrictfilenames': True,
-    'noplaylist': True,
+# Playlist youtube-dl options, entries are only enumerated as id/title stubs and resolved once they're played
+ytdl_flat_options = {
+    'extract_flat': 'in_playlist',
     'nocheckcertificate': True,
-    'ignoreerrors': False,
+    'ignoreerrors': True,
     'logtostderr': False,
     'quiet': True,
     'no_warnings': True,
-    'default_search': 'auto',
-    # bind to ipv4 since ipv6 addreacses cause issues sometimes
-    'source_addreacs': '0.0.0.0',
-    'output': r'youtube-dl',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '320',
-        }]
+    # bind to ipv4 since ipv6 addresses cause issues sometimes
+    'source_address': '0.0.0.0'
 }
 
+# Bitrates the download command can convert to, the highest one which fits the upload limit is used
+download_bitrates = (320, 256, 192, 160, 128, 96, 64, 48, 32)
+
 stim = {
     'default_search': 'auto',
     "ignoreerrors": True,
@@ -82,7 +88,12 @@ stim = {
 
 ffmpeg_options = {
     'options': '-vn',
-    # 'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+}
+
+# FFmpeg options used when playing directly from the media url instead of a downloaded file
+ffmpeg_stream_options = {
+    'options': '-vn',
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
 }
 
 if not os.path.isfile("config.json"):
@@ -91,9 +102,45 @@ else:
     with open("config.json") as file:
         config = json.load(file)
 
-class Downloader(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+# NOTE: normalized query -> song info, so adding the same song to the queue again doesn't query youtube
+info_cache = TTLCache(4096, 3600)
+
+# NOTE: queues are saved here periodically and restored once the bot restarts
+snapshot_file = config.get('music_snapshot_file', 'music_queues.json')
+
+# NOTE: defaults of the settings every server can change with the `music-settings` command
+default_settings = {'volume': 0.5, 'repeat': False, 'max_queue': config.get('music_max_queue', 1000)}
+
+# NOTE: parsers of the values given to the `music-settings` command
+setting_parsers = {
+    'volume': lambda value: max(0, min(int(value), 200)) / 100,
+    'repeat': lambda value: value.lower() in ('on', 'true', 'yes', '1'),
+    'max_queue': lambda value: max(1, int(value)),
+}
+
+# NOTE: YouTube Data API client shared by the whole process, text searches use it before falling back to youtube-dl
+youtube = get_client(config.get('yt_apikey', ''))
+
+# Priorities of media jobs, lower runs sooner
+PRIORITY_PLAY = 0  # song which is about to play
+PRIORITY_QUEUE = 1  # song info for the queue commands
+PRIORITY_PREFETCH = 2
+PRIORITY_BACKGROUND = 3  # cache downloads and the download command
+
+# NOTE: limits how many youtube-dl and FFmpeg jobs run at once so the bot doesn't thrash under load
+scheduler = JobScheduler(
+    resolve=config.get('music_resolve_jobs', 8),
+    download=config.get('music_download_jobs', 4),
+    transcode=config.get('music_transcode_jobs', 2),
+)
+
+class SongSource:
+    """
+    Song data and playback position shared by the PCM and Opus audio sources
+    """
+    replaced = None  # NOTE: source this one was swapped in for, cleaned up once the player thread moved on
+
+    def set_data(self, data, start=0):
         self.data = data
         self.title = data.get('title')
         self.url = data.get("url")
@@ -101,14 +148,93 @@ class Downloader(discord.PCMVolumeTransformer):
         self.duration = data.get('duration')
         self.views = data.get('view_count')
         self.playlist = {}
+        self.start = start
+        self.frames = 0
+
+    @property
+    def position(self):
+        """
+        Seconds of the song played so far, every frame is 20ms of audio
+        """
+        return self.start + self.frames * 0.02
+
+    def read(self):
+        if self.replaced is not None:
+            # NOTE: the player thread reads this source now, the replaced one can't be in read() anymore
+            self.cleanup_replaced()
+        ret = super().read()
+        if ret:
+            self.frames += 1
+        return ret
+
+    def cleanup_replaced(self):
+        replaced, self.replaced = self.replaced, None
+        if replaced is not None:
+            replaced.cleanup()
+
+    def cleanup(self):
+        # NOTE: the player only cleans up its current source, which may never have been read
+        self.cleanup_replaced()
+        super().cleanup()
+
+
+class OpusDownloader(SongSource, discord.FFmpegOpusAudio):
+    """
+    Audio source which gets opus straight from FFmpeg so discord.py doesn't need to encode it
+    The volume is applied by FFmpeg so changing it means restarting the source at the current position
+    """
+    def __init__(self, source, *, data, volume=0.5, start=0, **kwargs):
+        super().__init__(source, **kwargs)
+        self.set_data(data, start)
+        self.volume = volume
+
+
+class Downloader(SongSource, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5, start=0):
+        super().__init__(source, volume)
+        self.set_data(data, start)
+
+    @classmethod
+    def create(cls, name, *, data, stream=False, volume=0.5, start=0):
+        """
+        Create the cheapest audio source for a downloaded file or a stream url
+            - opus disabled in the config:
+                FFmpeg decodes to PCM, the volume is applied in python and discord.py encodes it to opus
+            - opus song at 100% volume:
+                FFmpeg copies the opus packets without decoding them
+            - anything else:
+                FFmpeg applies the volume and encodes to opus
+        """
+        options = dict(ffmpeg_stream_options if stream else ffmpeg_options)
+        if start:
+            options['before_options'] = f"{options.get('before_options', '')} -ss {start}".strip()
+
+        if not config.get('music_opus', True):
+            return cls(discord.FFmpegPCMAudio(name, **options), data=data, volume=volume, start=start)
+
+        if volume == 1 and data.get('acodec') == 'opus':
+            # NOTE: FFmpegOpusAudio only copies the packets when the codec is opus, 'copy' would be re-encoded
+            return OpusDownloader(name, data=data, volume=volume, start=start, codec='opus', **options)
+
+        options['options'] += f' -filter:a volume={volume}'
+        return OpusDownloader(name, data=data, volume=volume, start=start, **options)
 
     @classmethod
-    async def video_url(cls, url, ytdl, *, loop=None, stream=False):
+    async def extract(cls, url, ytdl, *, stream=False, priority=PRIORITY_PLAY, key=None):
         """
-        Download the song file and data
+        Download the song file and data without creating an audio source
+        Returns the song data, the playlist data and the file name/stream url
+        `key` allows promoting the job with `scheduler.promote()` while it waits
         """
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+        lane = 'resolve' if stream else 'download'
+        data = await scheduler.run(lane, ytdl.extract_info, url, download=not stream, priority=priority, key=key)
+        if data is not None and 'entries' in data:
+            # NOTE: entries which couldn't be extracted are None
+            data['entries'] = [entry for entry in data['entries'] if entry]
+        if data is None or 'entries' in data and not data['entries']:
+            # NOTE: youtube-dl returns nothing instead of raising because of `ignoreerrors`, like for private or deleted videos
+            raise youtube_dl.DownloadError(f"{url} is unavailable")
+
         song_list = {'queue': []}
         if 'entries' in data:
             if len(data['entries']) > 1:
@@ -119,11 +245,88 @@ class Downloader(discord.PCMVolumeTransformer):
             data = data['entries'][0]
 
         filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data), song_list
+        return data, song_list, filename
+
+    @classmethod
+    async def resolve(cls, url, *, priority=PRIORITY_PLAY, key=None):
+        """
+        Get the song data, the playlist data and the stream url without downloading the file
+        """
+        ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+        return await cls.extract(url, ytdl, stream=True, priority=priority, key=key)
 
-    async def get_info(self, url):
+    @staticmethod
+    def is_playlist(url):
+        """
+        Check if the query is a playlist url
+        """
+        return re.match(r'https?://', url) is not None and re.search(r'[?&]list=|/playlist', url) is not None
+
+    @staticmethod
+    def flat_playlist(url):
+        """
+        Get the playlist data without resolving its entries
+        The entries are a lazy iterator of id/title stubs which fetches the pages as it's consumed
+        Blocking, must be ran in an executor
+        """
+        ytdl = youtube_dl.YoutubeDL(ytdl_flat_options)
+        data = ytdl.extract_info(url, download=False, process=False)
+        while data.get('_type') == 'url':
+            # NOTE: url redirects to another extractor (like a youtube tab)
+            data = ytdl.extract_info(data['url'], download=False, process=False, ie_key=data.get('ie_key'))
+        return data
+
+    @staticmethod
+    def track_url(entry):
+        """
+        Get the url of a playlist entry stub
+        """
+        if entry.get('webpage_url'):
+            return entry['webpage_url']
+        if entry.get('ie_key') == 'Youtube':
+            return f"https://www.youtube.com/watch?v={entry['id']}"
+        return entry['url']
+
+    @classmethod
+    async def get_info(cls, url):
         """
         Get the info of the next song by not downloading the actual file but just the data of song/query
+        Returns the id, title, video url and duration of the song and the playlist data, results are cached for an hour
+        """
+        key = normalize_query(url)
+        if key in info_cache:
+            return info_cache[key]
+
+        info = await cls.search_info(url)
+        if info is not None:
+            info = info, {'queue': []}
+        else:
+            info = await scheduler.run('resolve', cls._get_info, url, priority=PRIORITY_QUEUE)
+        info_cache[key] = info
+        return info
+
+    @staticmethod
+    async def search_info(query):
+        """
+        Get the info of the first video found by a text search with the YouTube Data API
+        Returns None for urls, if there's no api key, the quota ran out or nothing was found
+        """
+        if re.match(r'https?://', query) or not youtube.enabled:
+            return None
+
+        try:
+            ids = await youtube.search(query)
+            if not ids:
+                return None
+            return (await youtube.get_videos(ids[:1])).get(ids[0])
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+            return None
+
+    @staticmethod
+    def _get_info(url):
+        """
+        Blocking part of `get_info()`, must be ran in an executor
         """
         yt = youtube_dl.YoutubeDL(stim)
         down = yt.extract_info(url, download=False)
@@ -133,20 +336,149 @@ class Downloader(discord.PCMVolumeTransformer):
                 playlist_titles = [title['title'] for title in down['entries']]
                 data1 = {'title': down['title'], 'queue': playlist_titles}
 
-            down = down['entries'][0]['title']
+            down = down['entries'][0]
+
+        info = {
+            'id': down.get('id'), 'extractor_key': down.get('extractor_key'), 'title': down['title'],
+            'webpage_url': down.get('webpage_url'), 'duration': down.get('duration')
+        }
+        return info, data1
 
-        return down, data1
+
+class Track(namedtuple('Track', 'id title url requester channel duration')):
+    """
+    A queued song, only ids are kept so the messages, members and channels can be garbage collected
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, msg, url, *, id=None, title=None, duration=None):
+        """
+        Create a track requested by the author of the command
+        """
+        return cls(id, title or url, url, msg.author.id, msg.channel.id, duration)
+
+
+class TrackQueue(deque):
+    """
+    Queue of tracks which keeps its total duration up to date so it isn't summed every time it's shown
+    """
+    def __init__(self, tracks=()):
+        super().__init__()
+        self.duration = 0
+        self.unknown = 0  # NOTE: tracks without a known duration
+        self.extend(tracks)
+
+    def _count(self, track, sign):
+        if track.duration:
+            self.duration += sign * track.duration
+        else:
+            self.unknown += sign
+
+    def append(self, track):
+        super().append(track)
+        self._count(track, 1)
+
+    def appendleft(self, track):
+        super().appendleft(track)
+        self._count(track, 1)
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def pop(self):
+        track = super().pop()
+        self._count(track, -1)
+        return track
+
+    def popleft(self):
+        track = super().popleft()
+        self._count(track, -1)
+        return track
+
+    def clear(self):
+        super().clear()
+        self.duration = 0
+        self.unknown = 0
+
+
+class GuildPlayer:
+    """
+    Player state of a server, cleared once the bot leaves the voice channel
+    """
+    __slots__ = ('guild_id', 'queue', 'source', 'track', 'name', 'stream', 'reset', 'repeat', 'stopped', 'volume', 'prefetch', 'starting', 'key')
+
+    def __init__(self, guild_id, volume=0.5):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
+        self.source = None  # NOTE: `Downloader` of the current song
+        self.track = None  # NOTE: `Track` of the current song
+        self.name = None  # NOTE: file name or stream url of the current song
+        self.key = None  # NOTE: cache key of the current song's pinned file, None if it's streamed
+        self.stream = False
+        self.reset = False
+        self.repeat = False
+        self.stopped = False  # NOTE: the song was stopped by a command and shouldn't be resumed
+        self.volume = volume
+        self.prefetch = None  # NOTE: (track, task) of the next song being downloaded while the current one plays
+        self.starting = None  # NOTE: task of the song started in the background by `start_next()`
 
 
 class MusicPlayer(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         # self.music=self.database.find_one('music')
-        self.player = {
-            "audio_files": []
-        }
+        # NOTE: guild id -> `GuildPlayer`
+        self.player = {}
+        # NOTE: downloaded songs are shared by every server and kept between restarts
+        # NOTE: both are evicted early once the disk has less than `music_min_free_space` MB left
+        min_free = config.get('music_min_free_space', 1024) * 1024**2
+        self.cache = AudioCache(config.get('music_cache_dir', 'audio_cache'), config.get('music_cache_size', 1024) * 1024**2, min_free=min_free)
+        # NOTE: mp3 files converted by the download command, reused for the same song and bitrate
+        self.converted = AudioCache(config.get('music_downloads_dir', 'downloads'), config.get('music_downloads_size', 256) * 1024**2, min_free=min_free)
+        # NOTE: servers asking for the same song at once share a single extraction, download and conversion
+        self.resolving = SingleFlight()
+        self.downloads = SingleFlight(cleanup=self.cache.release)
+        self.converting = SingleFlight(cleanup=self.converted.release)
+        # NOTE: cache key -> times the song was streamed in the last day, it's downloaded once it's streamed
+        # `music_cache_streams` times so one-off plays never touch the disk
+        self.stream_plays = TTLCache(4096, 86400)
+        # NOTE: read once at startup, changes are written in batches so the play commands never wait on the disk
+        self.settings = GuildSettings(config.get('music_settings_file', 'music_settings.db'), 'music', default_settings)
+        # NOTE: guild id -> time at which the bot leaves if nothing is played, checked by a single reaper task
+        self.idle = {}
+        self.idle_heap = []
+        self.idle_wakeup = asyncio.Event()
+        self.reaper = self.bot.loop.create_task(self.idle_reaper())
+        # NOTE: the snapshot isn't written until the previous one was restored
+        self.restored = False
+        self.last_snapshot = None
+        # NOTE: snapshots are written in the executor, an older one never overwrites a newer one
+        self.snapshot_version = 0
+        self.snapshot_written = 0
+        self.snapshot_lock = threading.Lock()
+        self.restoring = self.bot.loop.create_task(self.restore_players())
         # self.database_setup()
 
+    def cog_unload(self):
+        self.reaper.cancel()
+        # NOTE: an unfinished restore leaves the snapshot untouched so the reloaded cog restores it instead
+        self.restoring.cancel()
+        self.snapshot_players.cancel()
+        if self.restored:
+            self.save_snapshot()
+
+        # NOTE: stop the songs without starting the next ones, the reloaded cog resumes them from the snapshot
+        for guild_id in list(self.player):
+            self.cancel_prefetch(guild_id)
+        self.player.clear()
+        for voice_client in self.bot.voice_clients:
+            voice_client.stop()
+        self.cache.save()
+        self.converted.save()
+        self.settings.close()
+
     def database_setup(self):
         URL = os.getenv("MONGO")
         if URL is None:
@@ -160,161 +492,733 @@ class MusicPlayer(commands.Cog):
         """
         Get info from youtube
         """
-        API_KEY = config['yt_apikey']
-        youtube = build('youtube', 'v3', developerKey=API_KEY)
-        song_data = youtube.search().list(part='snippet').execute()
-        return song_data[0]
+        return await Downloader.search_info(song)
 
     @commands.Cog.listener('on_voice_state_update')
     async def music_voice(self, user, before, after):
         """
-        Clear the server's playlist after bot leave the voice channel
+        Clear the server's player after bot leave the voice channel
         """
         if after.channel is None and user.id == self.bot.user.id:
-            try:
-                self.player[user.guild.id]['queue'].clear()
-            except KeyError:
+            if user.guild.id not in self.player:
                 # NOTE: server ID not in bot's local self.player dict
                 # Server ID lost or was not in data before disconnecting
                 print(f"Failed to get guild id {user.guild.id}")
+                return
 
-    async def filename_generator(self):
+            await self.release_player(user.guild.id)
+
+    async def release_player(self, guild_id):
         """
-        Generate a unique file name for the song file to be named as
+        Drop the server's player and release its prefetch and cached file
         """
-        chars = list(string.ascii_letters+string.digits)
-        name = ''
-        for i in range(random.randint(9, 25)):
-            name += random.choice(chars)
+        self.idle.pop(guild_id, None)
+        if guild_id not in self.player:
+            return
+
+        self.cancel_prefetch(guild_id)
+        await self.clear_data(guild_id)
+        del self.player[guild_id]
 
-        if name not in self.player['audio_files']:
-            return name
+    def create_player(self, guild_id):
+        """
+        Create the player of a server with its saved settings
+        """
+        settings = self.settings.get(guild_id)
+        player = self.player[guild_id] = GuildPlayer(guild_id, settings['volume'])
+        player.repeat = settings['repeat']
+        return player
 
-        return await self.filename_generator()
+    def queue_space(self, guild_id):
+        """
+        Get how many more songs fit in the server's queue
+        """
+        return self.settings.get(guild_id)['max_queue'] - len(self.player[guild_id].queue)
 
-    async def playlist(self, data, msg):
+    async def playlist(self, data, request):
         """
         THIS FUNCTION IS FOR WHEN YOUTUBE LINK IS A PLAYLIST
-        Add song into the server's playlist inside the self.player dict
+        Add song into the server's queue, `request` is the track of the playlist query
+        """
+        player = self.player[self.bot.get_channel(request.channel).guild.id]
+        for i in data['queue'][:max(self.queue_space(player.guild_id), 0)]:
+            player.queue.append(request._replace(title=i, url=i))
+        self.schedule_prefetch(player.guild_id)
+
+    async def queue_playlist(self, guild, request, play=False):
         """
-        for i in data['queue']:
-            print(i)
-            self.player[msg.guild.id]['queue'].append(
-                {'title': i, 'author': msg})
+        Add the entries of a playlist to the server's queue page by page without resolving them
+        If play is true the first entry starts playing as soon as it's enumerated
+        """
+        player = self.player[guild.id]
+        if play:
+            # NOTE: the reaper mustn't leave the channel while the first entry is enumerated
+            self.mark_busy(guild.id)
+
+        count = 0
+        full = False
+        try:
+            data = await scheduler.run('resolve', Downloader.flat_playlist, request.url, priority=PRIORITY_QUEUE)
+            chunks = grouper(data['entries'] if 'entries' in data else [data], 50)
+            while not full:
+                # NOTE: every chunk may need to fetch the next page of the playlist
+                chunk = await scheduler.run('resolve', next, chunks, None, priority=PRIORITY_QUEUE)
+                if chunk is None:
+                    break
+
+                ids = [entry['id'] for entry in chunk if entry and entry.get('ie_key') == 'Youtube' and not entry.get('duration')]
+                if ids and youtube.enabled:
+                    # NOTE: one api request fills in the durations of the whole chunk
+                    try:
+                        videos = await youtube.get_videos(ids)
+                    except Exception as Error:
+                        print(Error)  # NOTE: output back the error for later debugging
+                        videos = {}
+                    for entry in chunk:
+                        if entry and entry.get('id') in videos:
+                            entry['duration'] = videos[entry['id']]['duration']
+                    # NOTE: private and deleted videos aren't returned by the api and would fail once they're played
+                    chunk = [entry for entry in chunk if not entry or entry.get('id') not in youtube.unavailable]
+
+                if self.player.get(guild.id) is not player:
+                    # NOTE: bot left the voice channel while the playlist was enumerated
+                    return
+
+                for entry in chunk:
+                    if entry is None:
+                        continue
+                    if self.queue_space(guild.id) <= 0:
+                        # NOTE: the rest of the playlist isn't enumerated at all
+                        full = True
+                        break
+                    player.queue.append(request._replace(
+                        id=entry.get('id'), title=entry.get('title') or entry.get('url'),
+                        url=Downloader.track_url(entry), duration=entry.get('duration')))
+                    count += 1
+
+                if (play or self.is_idle(guild)) and player.queue:
+                    # NOTE: the current song may have ended while the playlist was enumerated
+                    play = False
+                    self.start_next(guild)
+                else:
+                    self.schedule_prefetch(guild.id)
+        finally:
+            if play and self.player.get(guild.id) is player:
+                # NOTE: the playlist failed or had no entries, play the rest of the queue instead
+                if player.queue:
+                    self.start_next(guild)
+                else:
+                    self.mark_idle(guild.id)
+
+        # NOTE: needs to be embeded to make it better output
+        channel = self.bot.get_channel(request.channel)
+        if full:
+            return await channel.send(f"Added playlist {data.get('title') or request.url} to queue ({count} songs, the queue is full)")
+        return await channel.send(f"Added playlist {data.get('title') or request.url} to queue ({count} songs)")
+
+    def start_next(self, guild):
+        """
+        Start the head of the server's queue without waiting for it to be prepared, tracks which fail are skipped
+        The task is kept by the player until it's done and its errors are printed since nobody awaits it
+        """
+        player = self.player[guild.id]
+        self.mark_busy(guild.id)
+        player.starting = self.bot.loop.create_task(self.play_track(guild, player.queue.popleft()))
+        player.starting.add_done_callback(lambda task: self.started(player, task))
+
+    @staticmethod
+    def started(player, task):
+        """
+        Forget the task of `start_next()` once it's done and print its error
+        """
+        if player.starting is task:
+            player.starting = None
+        if not task.cancelled() and task.exception() is not None:
+            print(task.exception())  # NOTE: output back the error for later debugging
 
     async def queue(self, msg, song):
         """
         Add the query/song to the queue of the server
         """
-        title1 = await Downloader.get_info(self, url=song)
-        title = title1[0]
-        data = title1[1]
+        request = Track.create(msg, song)
+        if self.queue_space(msg.guild.id) <= 0:
+            return await msg.send(f"**The queue is full ({len(self.player[msg.guild.id].queue)} songs)**")
+
+        if Downloader.is_playlist(song):
+            return await self.queue_playlist(msg.guild, request)
+
+        info, data = await Downloader.get_info(song)
+        if msg.guild.id not in self.player:
+            # NOTE: bot left the voice channel while the song info was fetched
+            return
+
         # NOTE:needs fix here
         if data['queue']:
-            await self.playlist(data, msg)
+            await self.playlist(data, request)
             # NOTE: needs to be embeded to make it better output
-            return await msg.send(f"Added playlist {data['title']} to queue")
-        self.player[msg.guild.id]['queue'].append(
-            {'title': title, 'author': msg})
-        return await msg.send(f"**{title} added to queue**".title())
+            await msg.send(f"Added playlist {data['title']} to queue")
+        else:
+            self.player[msg.guild.id].queue.append(request._replace(
+                id=info['id'], title=info['title'], url=info['webpage_url'] or song, duration=info['duration']))
+            await msg.send(f"**{info['title']} added to queue**".title())
+
+        if msg.guild.id not in self.player:
+            return
+        if self.is_idle(msg.guild) and self.player[msg.guild.id].queue:
+            # NOTE: the song ended while the info was fetched and nothing is going to start the queue
+            return await self.play_track(msg.guild, self.player[msg.guild.id].queue.popleft())
+        self.schedule_prefetch(msg.guild.id)
+
+    def snapshot(self):
+        """
+        Get the state of every server's player, tracks keep their resolved data so they don't need to be searched again
+        """
+        guilds = []
+        for guild_id, player in self.player.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None or guild.voice_client is None:
+                continue
+
+            current, position = None, 0
+            if player.track is not None and player.name is not None:
+                current = player.track._replace(url=player.source.data.get('webpage_url') or player.track.url)
+                position = round(player.source.position, 2)
+
+            guilds.append({
+                'guild': guild_id, 'channel': guild.voice_client.channel.id, 'volume': player.volume,
+                'repeat': player.repeat, 'current': current, 'position': position, 'queue': list(player.queue)
+            })
+        return {'guilds': guilds}
+
+    def save_snapshot(self):
+        """
+        Write the snapshot of the players to disk right away, blocking
+        """
+        self.snapshot_version += 1
+        self.write_snapshot(self.snapshot(), self.snapshot_version)
 
-    async def voice_check(self, msg):
+    def write_snapshot(self, snapshot, version):
         """
-        function used to make bot leave voice channel if music not being played for longer than 2 minutes
+        Write a snapshot to disk if it changed since the last one and no newer one was written, blocking
         """
-        if msg.voice_client is not None:
-            await asyncio.sleep(120)
-            if msg.voice_client is not None and msg.voice_client.is_playing() is False and msg.voice_client.is_paused() is False:
-                await msg.voice_client.disconnect()
+        snapshot = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':'))
+        with self.snapshot_lock:
+            if version <= self.snapshot_written or snapshot == self.last_snapshot:
+                return
+
+            with open(snapshot_file + '.tmp', 'w', encoding='utf8') as file:
+                file.write(snapshot)
+            os.replace(snapshot_file + '.tmp', snapshot_file)
+            self.last_snapshot = snapshot
+            self.snapshot_written = version
+
+    @tasks.loop(seconds=30)
+    async def snapshot_players(self):
+        """
+        Save the players periodically so a crash loses at most 30 seconds of changes
+        The snapshot is taken on the loop, dumping and writing it happens in the executor
+        """
+        try:
+            self.snapshot_version += 1
+            await to_thread(self.write_snapshot, self.snapshot(), self.snapshot_version)
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+
+    async def restore_players(self):
+        """
+        Rejoin the voice channels and restore the queues saved in the last snapshot
+        """
+        await self.bot.wait_until_ready()
+        try:
+            with open(snapshot_file, encoding='utf8') as file:
+                snapshot = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            snapshot = {'guilds': []}
+
+        # NOTE: every server is restored at once, the job scheduler limits how many songs are prepared at a time
+        await asyncio.gather(*(self.restore_guild(state) for state in snapshot['guilds']))
+        self.restored = True
+        self.snapshot_players.start()
 
-    async def clear_data(self, msg):
+    async def restore_guild(self, state):
         """
-        Clear the local dict data
-            name - remove file name from dict
-            remove file and filename from directory
-            remove filename from global audio file names
+        Restore the player of a server, a failed restore leaves the server idle
         """
-        name = self.player[msg.guild.id]['name']
-        os.remove(name)
-        self.player['audio_files'].remove(name)
+        try:
+            await self.restore_player(state)
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+            if state['guild'] in self.player:
+                self.mark_idle(state['guild'])
+
+    async def restore_player(self, state):
+        """
+        Restore the player of a server and resume its song where it was
+        Queued tracks aren't resolved until they're played
+        """
+        guild = self.bot.get_guild(state['guild'])
+        channel = guild.get_channel(state['channel']) if guild is not None else None
+        if channel is None or guild.id in self.player:
+            return
+
+        if guild.voice_client is None:
+            await channel.connect()
+        elif guild.voice_client.channel != channel:
+            await guild.voice_client.move_to(channel)
+
+        player = self.create_player(guild.id)
+        player.volume = state['volume']
+        player.repeat = state['repeat']
+        player.queue.extend(Track(*track) for track in state['queue'])
+        if state['current'] is not None:
+            return await self.play_track(guild, Track(*state['current']), start=state['position'])
+
+        if player.queue:
+            return await self.play_track(guild, player.queue.popleft())
+
+        self.mark_idle(guild.id)
+
+    def mark_idle(self, guild_id, delay=120):
+        """
+        Make the bot leave the voice channel if music is not being played for longer than 2 minutes
+        """
+        deadline = time.monotonic() + delay
+        self.idle[guild_id] = deadline
+        heapq.heappush(self.idle_heap, (deadline, guild_id))
+        if self.idle_heap[0][1] == guild_id:
+            # NOTE: new earliest deadline, wake the reaper up so it sleeps for the right amount of time
+            self.idle_wakeup.set()
+
+    def mark_busy(self, guild_id):
+        """
+        Cancel the server's idle disconnect, the stale heap entry is skipped by the reaper
+        """
+        self.idle.pop(guild_id, None)
+
+    def is_idle(self, guild):
+        """
+        Check if nothing is playing, paused or being prepared in the server
+        """
+        voice_client = guild.voice_client
+        if guild.id not in self.idle or voice_client is None:
+            return False
+        return not (voice_client.is_playing() or voice_client.is_paused())
+
+    async def idle_reaper(self):
+        """
+        Single task which disconnects idle voice clients once their deadline passes
+        """
+        await self.bot.wait_until_ready()
+        while True:
+            self.idle_wakeup.clear()
+            now = time.monotonic()
+            while self.idle_heap and self.idle_heap[0][0] <= now:
+                deadline, guild_id = heapq.heappop(self.idle_heap)
+                if self.idle.get(guild_id) != deadline:
+                    continue
+
+                del self.idle[guild_id]
+                try:
+                    await self.disconnect_idle(guild_id)
+                except Exception as Error:
+                    print(Error)  # NOTE: output back the error for later debugging
+
+            timeout = self.idle_heap[0][0] - now if self.idle_heap else None
+            try:
+                await asyncio.wait_for(self.idle_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-    async def loop_song(self, msg):
+    async def disconnect_idle(self, guild_id):
         """
-        Loop the currently playing song by replaying the same audio file via `discord.PCMVolumeTransformer()`
+        Leave the voice channel of an idle server, paused players are checked again later
         """
-        source = discord.PCMVolumeTransformer(
-            discord.FFmpegPCMAudio(self.player[msg.guild.id]['name']))
+        guild = self.bot.get_guild(guild_id)
+        voice_client = guild.voice_client if guild is not None else None
+        if voice_client is None:
+            return await self.release_player(guild_id)
+
+        if voice_client.is_paused() is True:
+            return self.mark_idle(guild_id)
+
+        if voice_client.is_playing() is False:
+            await voice_client.disconnect()
+            await self.release_player(guild_id)
+
+    async def clear_data(self, guild_id):
+        """
+        Clear the server's player data
+            release the song's cached file so it can be evicted
+        """
+        player = self.player[guild_id]
+        if player.key is not None:
+            self.cache.release(player.key)
+        player.key = None
+        player.name = None
+
+    def release_song(self, prepared):
+        """
+        Release the cached file of a song returned by `prepare_song()` which won't be played
+        """
+        song_data, data, name, stream = prepared
+        if stream is False:
+            self.cache.release(cache_key(song_data))
+
+    def schedule_prefetch(self, guild_id):
+        """
+        Start downloading the next song in the server's queue while the current one is playing
+        Only the head of the queue is downloaded ahead, so there's at most one prefetch per server
+        """
+        player = self.player[guild_id]
+        if not player.queue:
+            return
+
+        track = player.queue[0]
+        if player.prefetch is not None:
+            if player.prefetch[0] is track:
+                return
+            # NOTE: head of the queue changed since the prefetch started
+            self.cancel_prefetch(guild_id)
+
+        task = self.bot.loop.create_task(self.prepare_song(track.url, stream=config.get('music_stream', True), priority=PRIORITY_PREFETCH))
+        player.prefetch = (track, task)
+
+    def cancel_prefetch(self, guild_id):
+        """
+        Cancel the server's prefetch and release the file it downloaded
+        """
+        player = self.player[guild_id]
+        if player.prefetch is None:
+            return
+
+        track, task = player.prefetch
+        player.prefetch = None
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            self.release_song(task.result())
+
+    async def take_prefetch(self, guild_id, track):
+        """
+        Get the prefetched data of the track that is about to play
+        Returns None if the track wasn't prefetched, the prefetch failed or is still running
+        """
+        player = self.player[guild_id]
+        if player.prefetch is None:
+            return None
+
+        if player.prefetch[0] is not track:
+            self.cancel_prefetch(guild_id)
+            return None
+
+        track, task = player.prefetch
+        if not task.done():
+            # NOTE: the prefetch still runs at its low priority, preparing the song again joins
+            # the same extraction and download and moves them ahead of the other jobs
+            self.cancel_prefetch(guild_id)
+            return None
+
+        player.prefetch = None
+        try:
+            return await task
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+            return None
+
+    def restart_song(self, guild, position):
+        """
+        Swap the currently playing source for a new one starting at the position
+        The current song keeps going so the `after` callback of the old source isn't called
+        The old source is cleaned up by the player thread once it moved on to the new one
+        Returns False if nothing is playing or paused, like right after a skip
+        """
+        voice_client = guild.voice_client
+        if voice_client is None or not (voice_client.is_playing() or voice_client.is_paused()):
+            return False
+
+        player = self.player[guild.id]
+        paused = voice_client.is_paused()
+        source = Downloader.create(player.name, data=player.source.data, stream=player.stream, volume=player.volume, start=position)
+        # NOTE: the player thread may still be in read() of the old source, killing its FFmpeg now would end the song
+        source.replaced = voice_client.source
+        voice_client.source = source
+        if paused:
+            # NOTE: swapping the source resumes the song
+            voice_client.pause()
+        player.source = source
+        return True
+
+    async def loop_song(self, guild, start=0, msgId=None):
+        """
+        Loop the currently playing song by replaying the same audio file or stream url
+        `start` is the position in seconds the song is replayed from
+        """
+        player = self.player[guild.id]
+        source = Downloader.create(player.name, data=player.source.data, stream=player.stream, volume=player.volume, start=start)
+        player.source = source
         loop = asyncio.get_event_loop()
         try:
-            msg.voice_client.play(
-                source, after=lambda a: loop.create_task(self.done(msg)))
-            msg.voice_client.source.volume = self.player[msg.guild.id]['volume']
+            guild.voice_client.play(
+                source, after=lambda a: loop.create_task(self.done(guild.id, msgId, error=a)))
             # if str(msg.guild.id) in self.music:
             #     msg.voice_client.source.volume=self.music['vol']/100
         except Exception as Error:
             # Has no attribute play
             print(Error)  # NOTE: output back the error for later debugging
 
-    async def done(self, msg, msgId: int = None):
+    async def done(self, guild_id, msgId: int = None, error=None):
         """
         Function to run once song completes
         Delete the "Now playing" message via ID
+        Resume the song where it stopped if its audio ended early
+        Replay the song from a downloaded file if the stream failed
         """
+        player = self.player.get(guild_id)
+        if player is None:
+            # NOTE: bot left the voice channel and the player was cleared
+            return
+
+        guild = self.bot.get_guild(guild_id)
+        source = player.source
+        stopped, player.stopped = player.stopped, False
+        if not stopped and error is None and player.reset is False and source.frames and source.duration and source.position < source.duration - 5:
+            # NOTE: the audio stopped early (like FFmpeg losing its input during a voice reconnect),
+            # resume from the same file or stream url, every resume has to play some audio so this can't loop forever
+            print(f"Song ended early at {source.position:.0f}s, resuming")
+            return await self.loop_song(guild, start=source.position, msgId=msgId)
+
         if msgId:
             try:
-                message = await msg.channel.fetch_message(msgId)
-                await message.delete()
+                await self.bot.get_channel(player.track.channel).get_partial_message(msgId).delete()
             except Exception as Error:
                 print("Failed to get the message")
 
-        if self.player[msg.guild.id]['reset'] is True:
-            self.player[msg.guild.id]['reset'] = False
-            return await self.loop_song(msg)
+        if not stopped and player.stream is True and (error is not None or source.frames == 0):
+            # NOTE: stream failed, continue from the cached or downloaded file where the stream stopped
+            print(f"Stream failed, downloading instead: {error}")
+            song = source.data.get('webpage_url') or source.title
+            return await self.play_track(guild, player.track._replace(url=song), stream=False, start=source.position)
+
+        if player.reset is True:
+            player.reset = False
+            return await self.loop_song(guild)
 
-        if msg.guild.id in self.player and self.player[msg.guild.id]['repeat'] is True:
-            return await self.loop_song(msg)
+        if player.repeat is True:
+            return await self.loop_song(guild)
 
-        await self.clear_data(msg)
+        await self.clear_data(guild_id)
 
-        if self.player[msg.guild.id]['queue']:
-            queue_data = self.player[msg.guild.id]['queue'].pop(0)
-            return await self.start_song(msg=queue_data['author'], song=queue_data['title'])
+        if player.queue:
+            track = player.queue.popleft()
+            prepared = await self.take_prefetch(guild_id, track)
+            return await self.play_track(guild, track, prepared=prepared)
 
         else:
-            await self.voice_check(msg)
+            self.mark_idle(guild_id)
+
+    async def play_track(self, guild, track, prepared=None, **kwargs):
+        """
+        Play a track with `start_song()`, if it can't be played a message is sent to its channel and the next
+        queued track is played instead until one of them plays or the queue is empty
+        """
+        while True:
+            try:
+                return await self.start_song(guild, track, prepared=prepared, **kwargs)
+            except Exception as Error:
+                print(Error)  # NOTE: output back the error for later debugging
 
-    async def start_song(self, msg, song):
-        new_opts = ytdl_format_options.copy()
-        audio_name = await self.filename_generator()
+            channel = self.bot.get_channel(track.channel)
+            try:
+                await channel.send(f"**Couldn't play {track.title}, skipping it**", delete_after=60)
+            except Exception as Error:
+                print(Error)  # NOTE: output back the error for later debugging
 
-        self.player['audio_files'].append(audio_name)
-        new_opts['outtmpl'] = new_opts['outtmpl'].format(audio_name)
+            player = self.player.get(guild.id)
+            if player is None or not player.queue or not self.is_idle(guild):
+                # NOTE: the bot left, the queue is empty (`start_song()` marked the server idle) or another song started
+                return
+            track, kwargs = player.queue.popleft(), {}
+            prepared = await self.take_prefetch(guild.id, track)
+
+    async def prepare_song(self, song, stream=False, priority=PRIORITY_PLAY):
+        """
+        Download the song file and data without playing it
+        Returns the song data, the playlist data, the audio file name or stream url and whether it's a stream
+        Songs in the cache are played from the cached file without using youtube-dl, cached files are pinned until released
+        """
+        key = self.cache.get(song)
+        if key is not None:
+            return self.cache.acquire(key), {'queue': []}, self.cache.path(key), False
+
+        song_data, data, url = await self.resolve_song(song, priority=priority)
+        key = cache_key(song_data)
+        if key in self.cache:
+            if not data['queue']:
+                self.cache.alias(song, key)
+            return self.cache.acquire(key), data, self.cache.path(key), False
+
+        if not data['queue']:
+            # NOTE: aliases of songs which aren't cached yet are ignored until they are
+            self.cache.alias(song, key)
+
+        if stream:
+            plays = self.stream_plays[key] = self.stream_plays.get(key, 0) + 1
+            cache_after = config.get('music_cache_streams', 2)
+            if cache_after and plays >= cache_after:
+                # NOTE: the song is played repeatedly, download it in the background so it's a cache hit next time
+                self.bot.loop.create_task(self.cache_song(song_data))
+            return song_data, data, url, True
+
+        song_data = await self.fetch_song(song_data, priority=priority)
+        return song_data, data, self.cache.path(key), False
+
+    async def resolve_song(self, song, priority=PRIORITY_PLAY):
+        """
+        Get the song data, the playlist data and the stream url of a query
+        Servers resolving the same query at once share a single youtube-dl extraction
+        """
+        key = normalize_query(song)
+        if key in self.resolving:
+            # NOTE: the shared extraction may be waiting at a lower priority, like a prefetch of the song about to play
+            scheduler.promote('resolve', key, priority)
+        return await self.resolving.run(key, Downloader.resolve, song, priority=priority, key=key)
 
-        ytdl = youtube_dl.YoutubeDL(new_opts)
-        download1 = await Downloader.video_url(song, ytdl=ytdl, loop=self.bot.loop)
-        download = download1[0]
-        data = download1[1]
-        self.player[msg.guild.id]['name'] = audio_name
+    async def fetch_song(self, song_data, priority=PRIORITY_PLAY):
+        """
+        Download a resolved song into the cache, the cached file is pinned until released
+        Servers downloading the same video at once share a single download, each of them gets its own pin
+        """
+        key = cache_key(song_data)
+        if key in self.cache:
+            return self.cache.acquire(key)
+
+        if key in self.downloads:
+            # NOTE: the shared download may be waiting at a lower priority, like a background cache download
+            # of a song whose stream just failed
+            scheduler.promote('download', key, priority)
+        async with self.downloads.join(key, self._fetch_song, song_data, priority):
+            # NOTE: the download's own pin is released once every server sharing it pinned the file
+            return self.cache.acquire(key)
+
+    async def _fetch_song(self, song_data, priority):
+        """
+        Download job shared by `fetch_song()`, the file is pinned until every server got it
+        Returns the cache key of the song
+        """
+        key = cache_key(song_data)
+        ytdl = youtube_dl.YoutubeDL(dict(ytdl_format_options, outtmpl=self.cache.template(key)))
+        # NOTE: the thread can't be interrupted, the file is added to the cache even if every server gave up on it
+        await scheduler.run('download', ytdl.process_info, dict(song_data), priority=priority, key=key)
+        # NOTE: the video url is aliased too so restored and requeued tracks are cache hits
+        return self.cache.add(song_data, query=song_data.get('webpage_url'), pin=True)
+
+    async def download_song(self, song, priority=PRIORITY_PLAY):
+        """
+        Download a song into the cache, the cached file is pinned until released
+        Returns the song data and the playlist data
+        """
+        song_data, data, url = await self.resolve_song(song, priority=priority)
+        song_data = await self.fetch_song(song_data, priority=priority)
+        if not data['queue']:
+            self.cache.alias(song, cache_key(song_data))
+        return song_data, data
+
+    async def cache_song(self, song_data):
+        """
+        Download a resolved song into the cache without playing it
+        """
+        try:
+            song_data = await self.fetch_song(song_data, priority=PRIORITY_BACKGROUND)
+            self.cache.release(cache_key(song_data))
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+
+    async def start_song(self, guild, track, prepared=None, stream=None, start=0):
+        """
+        Play a track, `prepared` is the result of `prepare_song()` if the song was already downloaded
+        `start` is the position in seconds the song starts at
+        Songs are streamed unless `music_stream` is disabled in the config, falling back to downloading
+        """
+        song = track.url
+        if prepared is None and Downloader.is_playlist(song):
+            return await self.queue_playlist(guild, track, play=True)
+
+        if stream is None:
+            stream = config.get('music_stream', True)
+
+        # NOTE: preparing the song can take a while, the reaper mustn't leave the channel in the meantime
+        self.mark_busy(guild.id)
+        try:
+            if prepared is None and self.cache.get(song) is None and normalize_query(song) not in self.resolving:
+                # NOTE: the data api finds text searches much faster than youtube-dl,
+                # queries which are already being extracted (like an unfinished prefetch) join that extraction instead
+                info = await Downloader.search_info(song)
+                if info is not None:
+                    song = info['webpage_url']
+
+            if prepared is None:
+                try:
+                    prepared = await self.prepare_song(song, stream=stream)
+                except Exception as Error:
+                    if not stream:
+                        raise
+                    print(f"Failed to get the stream url, downloading instead: {Error}")
+                    prepared = await self.prepare_song(song, stream=False)
+        except Exception:
+            self.mark_idle(guild.id)
+            raise
+
+        voice_client = guild.voice_client
+        if voice_client is None or guild.id not in self.player:
+            # NOTE: bot left the voice channel while the song was being prepared
+            return self.release_song(prepared)
+
+        song_data, data, audio_name, stream = prepared
         emb = discord.Embed(colour=self.random_color, title='Now Playing',
-                            description=download.title, url=download.url)
-        emb.set_thumbnail(url=download.thumbnail)
-        emb.set_footer(
-            text=f'Requested by {msg.author.display_name}', icon_url=msg.author.avatar_url)
+                            description=song_data.get('title'), url=song_data.get('webpage_url', song_data.get('url')))
+        emb.set_thumbnail(url=song_data.get('thumbnail'))
+        requester = guild.get_member(track.requester)
+        if requester is not None:
+            emb.set_footer(
+                text=f'Requested by {requester.display_name}', icon_url=requester.avatar_url)
         loop = asyncio.get_event_loop()
 
         if data['queue']:
-            await self.playlist(data, msg)
+            await self.playlist(data, track)
+
+        try:
+            msgId = (await self.bot.get_channel(track.channel).send(embed=emb)).id
+        except Exception as Error:
+            # NOTE: the song still plays if the message can't be sent, like without the permission to send embeds
+            print(Error)  # NOTE: output back the error for later debugging
+            msgId = None
+
+        voice_client = guild.voice_client
+        if voice_client is None or guild.id not in self.player:
+            # NOTE: bot left the voice channel while the message was sent
+            return self.release_song(prepared)
 
-        msgId = await msg.send(embed=emb)
-        self.player[msg.guild.id]['player'] = download
-        self.player[msg.guild.id]['author'] = msg
-        msg.voice_client.play(
-            download, after=lambda a: loop.create_task(self.done(msg, msgId.id)))
+        player = self.player[guild.id]
+        download = Downloader.create(audio_name, data=song_data, stream=stream, volume=player.volume, start=start)
+        try:
+            voice_client.play(
+                download, after=lambda a: loop.create_task(self.done(guild.id, msgId, error=a)))
+        except Exception:
+            download.cleanup()
+            self.release_song(prepared)
+            raise
+
+        # NOTE: the player only changes once the song plays so a failure above leaves the current song untouched
+        player.name = audio_name
+        player.stream = stream
+        player.key = None if stream else cache_key(song_data)
+        player.source = download
+        player.track = track._replace(id=song_data.get('id'), title=download.title, duration=download.duration)
 
         # if str(msg.guild.id) in self.music: #NOTE adds user's default volume if in database
         #     msg.voice_client.source.volume=self.music[str(msg.guild.id)]['vol']/100
-        msg.voice_client.source.volume = self.player[msg.guild.id]['volume']
-        return msg.voice_client
+        self.schedule_prefetch(guild.id)
+        return voice_client
 
     @command()
     async def play(self, msg, *, song):
@@ -324,27 +1228,16 @@ class MusicPlayer(commands.Cog):
         `Command:` play(song_name)
         """
         if msg.guild.id in self.player:
-            if msg.voice_client.is_playing() is True:  # NOTE: SONG CURRENTLY PLAYING
-                return await self.queue(msg, song)
-
-            if self.player[msg.guild.id]['queue']:
+            if not self.is_idle(msg.guild):
+                # NOTE: a song is playing, paused or being prepared (like the first page of a playlist)
                 return await self.queue(msg, song)
 
-            if msg.voice_client.is_playing() is False and not self.player[msg.guild.id]['queue']:
-                return await self.start_song(msg, song)
+            return await self.play_track(msg.guild, Track.create(msg, song))
 
         else:
-            # IMPORTANT: THE ONLY PLACE WHERE NEW `self.player[msg.guild.id]={}` IS CREATED
-            self.player[msg.guild.id] = {
-                'player': None,
-                'queue': [],
-                'author': msg,
-                'name': None,
-                "reset": False,
-                'repeat': False,
-                'volume': 0.5
-            }
-            return await self.start_song(msg, song)
+            # IMPORTANT: THE ONLY PLACE WHERE NEW `self.player[msg.guild.id]` IS CREATED (besides restoring snapshots)
+            self.create_player(msg.guild.id)
+            return await self.play_track(msg.guild, Track.create(msg, song))
 
     @play.before_invoke
     async def before_play(self, msg):
@@ -370,11 +1263,11 @@ class MusicPlayer(commands.Cog):
         if msg.voice_client.channel != msg.author.voice.channel:
 
             # NOTE: Check player and queue
-            if msg.voice_client.is_playing() is False and not self.player[msg.guild.id]['queue']:
+            if msg.voice_client.is_playing() is False and not self.player[msg.guild.id].queue:
                 return await msg.voice_client.move_to(msg.author.voice.channel)
                 # NOTE: move bot to user's voice channel if queue does not exist
 
-            if self.player[msg.guild.id]['queue']:
+            if self.player[msg.guild.id].queue:
                 # NOTE: user must join same voice channel if queue exist
                 return await msg.send("Please join the same voice channel as the bot to add song to queue")
 
@@ -388,11 +1281,11 @@ class MusicPlayer(commands.Cog):
         """
         if msg.guild.id in self.player:
             if msg.voice_client.is_playing() is True:
-                if self.player[msg.guild.id]['repeat'] is True:
-                    self.player[msg.guild.id]['repeat'] = False
+                if self.player[msg.guild.id].repeat is True:
+                    self.player[msg.guild.id].repeat = False
                     return await msg.message.add_reaction(emoji='✅')
 
-                self.player[msg.guild.id]['repeat'] = True
+                self.player[msg.guild.id].repeat = True
                 return await msg.message.add_reaction(emoji='✅')
 
             return await msg.send("No audio currently playing")
@@ -412,10 +1305,10 @@ class MusicPlayer(commands.Cog):
         if msg.author.voice is None or msg.author.voice.channel != msg.voice_client.channel:
             return await msg.send(f"**{msg.author.display_name}, you must be in the same voice channel as the bot.**")
 
-        if self.player[msg.guild.id]['queue'] and msg.voice_client.is_playing() is False:
+        if self.player[msg.guild.id].queue and msg.voice_client.is_playing() is False:
             return await msg.send("**No audio currently playing or songs in queue**".title(), delete_after=25)
 
-        self.player[msg.guild.id]['reset'] = True
+        self.player[msg.guild.id].reset = True
         msg.voice_client.stop()
 
     @commands.has_permissions(manage_channels=True)
@@ -432,10 +1325,11 @@ class MusicPlayer(commands.Cog):
         if msg.author.voice is None or msg.author.voice.channel != msg.voice_client.channel:
             return await msg.send("Please join the same voice channel as the bot")
 
-        if not self.player[msg.guild.id]['queue'] and msg.voice_client.is_playing() is False:
+        if not self.player[msg.guild.id].queue and msg.voice_client.is_playing() is False:
             return await msg.send("**No songs in queue to skip**".title(), delete_after=60)
 
-        self.player[msg.guild.id]['repeat'] = False
+        self.player[msg.guild.id].repeat = False
+        self.player[msg.guild.id].stopped = True
         msg.voice_client.stop()
         return await msg.message.add_reaction(emoji='✅')
 
@@ -454,9 +1348,11 @@ class MusicPlayer(commands.Cog):
             return await msg.send("You must be in the same voice channel as the bot")
 
         if msg.author.voice is not None and msg.voice_client is not None:
-            if msg.voice_client.is_playing() is True or self.player[msg.guild.id]['queue']:
-                self.player[msg.guild.id]['queue'].clear()
-                self.player[msg.guild.id]['repeat'] = False
+            if msg.voice_client.is_playing() is True or self.player[msg.guild.id].queue:
+                self.player[msg.guild.id].queue.clear()
+                self.cancel_prefetch(msg.guild.id)
+                self.player[msg.guild.id].repeat = False
+                self.player[msg.guild.id].stopped = True
                 msg.voice_client.stop()
                 return await msg.message.add_reaction(emoji='✅')
 
@@ -471,8 +1367,10 @@ class MusicPlayer(commands.Cog):
         `Command:` leave()
         """
         if msg.author.voice is not None and msg.voice_client is not None:
-            if msg.voice_client.is_playing() is True or self.player[msg.guild.id]['queue']:
-                self.player[msg.guild.id]['queue'].clear()
+            if msg.voice_client.is_playing() is True or self.player[msg.guild.id].queue:
+                self.player[msg.guild.id].queue.clear()
+                self.cancel_prefetch(msg.guild.id)
+                self.player[msg.guild.id].stopped = True
                 msg.voice_client.stop()
                 return await msg.voice_client.disconnect(), await msg.message.add_reaction(emoji='✅')
 
@@ -481,6 +1379,52 @@ class MusicPlayer(commands.Cog):
         if msg.author.voice is None:
             return await msg.send("You must be in the same voice channel as bot to disconnect it via command")
 
+    @staticmethod
+    def parse_timestamp(timestamp):
+        """
+        Get the seconds of a timestamp like 90, 1:30 or 1:02:03
+        """
+        parts = timestamp.split(':')
+        if len(parts) > 3:
+            raise ValueError(f"invalid timestamp: {timestamp}")
+
+        seconds = 0
+        for part in parts:
+            value = float(part)
+            # NOTE: the seconds end up in FFmpeg's -ss, nan, inf and negative parts like 1:-30 are rejected
+            if not math.isfinite(value) or value < 0 or part.strip().startswith('-'):
+                raise ValueError(f"invalid timestamp: {timestamp}")
+            seconds = seconds * 60 + value
+        return seconds
+
+    @commands.has_permissions(manage_channels=True)
+    @command(aliases=['jump'])
+    async def seek(self, msg, timestamp):
+        """
+        Jump to a position of the currently playing song, the song isn't downloaded again
+        `Ex:` s.seek 1:30
+        `Command:` seek(timestamp)
+        """
+        if msg.voice_client is None or msg.guild.id not in self.player or self.player[msg.guild.id].name is None:
+            return await msg.send("**No audio currently playing**".title(), delete_after=30)
+
+        if msg.author.voice is None or msg.author.voice.channel != msg.voice_client.channel:
+            return await msg.send("Please join the same voice channel as the bot")
+
+        try:
+            position = self.parse_timestamp(timestamp)
+        except ValueError:
+            return await msg.send("**Please use a timestamp like 90, 1:30 or 1:02:03**", delete_after=30)
+
+        player = self.player[msg.guild.id]
+        if position < 0 or player.source.duration and position >= player.source.duration:
+            return await msg.send(f"**The song is only {timedelta(seconds=round(player.source.duration or 0))} long**", delete_after=30)
+
+        # NOTE: FFmpeg seeks the input of the same file or stream url
+        if not self.restart_song(msg.guild, position):
+            return await msg.send("**No audio currently playing**".title(), delete_after=30)
+        return await msg.message.add_reaction(emoji='✅')
+
     @commands.has_permissions(manage_channels=True)
     @command()
     async def pause(self, msg):
@@ -522,18 +1466,47 @@ class MusicPlayer(commands.Cog):
         """
         if msg.voice_client is not None:
             if msg.guild.id in self.player:
-                if self.player[msg.guild.id]['queue']:
-                    emb = discord.Embed(
-                        colour=self.random_color, title='queue')
-                    emb.set_footer(
-                        text=f'Command used by {msg.author.name}', icon_url=msg.author.avatar_url)
-                    for i in self.player[msg.guild.id]['queue']:
-                        emb.add_field(
-                            name=f"**{i['author'].author.name}**", value=i['title'], inline=False)
-                    return await msg.send(embed=emb, delete_after=120)
+                if self.player[msg.guild.id].queue:
+                    return await send_pages(msg, msg, self.queue_pages(msg, self.player[msg.guild.id]))
 
         return await msg.send("No songs in queue")
 
+    def queue_pages(self, msg, player, per_page=10):
+        """
+        Render the pages of the queue once they're viewed, only the tracks on the page are read from the queue
+        """
+        pages = (len(player.queue) - 1) // per_page + 1
+        for page in range(pages):
+            tracks = list(islice(player.queue, page * per_page, (page + 1) * per_page))
+            if not tracks:
+                # NOTE: songs were played or removed since the queue was shown
+                return
+
+            emb = discord.Embed(colour=self.random_color, title='queue', description=self.remaining(player))
+            emb.set_footer(
+                text=f'Page {page + 1}/{pages} - Command used by {msg.author.name}', icon_url=msg.author.avatar_url)
+            for index, track in enumerate(tracks, page * per_page + 1):
+                requester = msg.guild.get_member(track.requester)
+                length = timedelta(seconds=round(track.duration)) if track.duration else 'unknown length'
+                emb.add_field(
+                    name=f"{index}. {track.title}"[:256],
+                    value=f"`{length}` requested by **{requester.name if requester else 'unknown'}**", inline=False)
+            yield emb
+
+    @staticmethod
+    def remaining(player):
+        """
+        Get the total remaining time of the current song and the queue
+        """
+        seconds = player.queue.duration
+        if player.name is not None and player.source.duration:
+            seconds += max(player.source.duration - player.source.position, 0)
+
+        text = f"Total remaining: `{timedelta(seconds=round(seconds))}`"
+        if player.queue.unknown:
+            text += f" (+{player.queue.unknown} songs of unknown length)"
+        return text
+
     @command(name='song-info', aliases=['song?', 'nowplaying', 'current-song'])
     async def song_info(self, msg):
         """
@@ -542,12 +1515,13 @@ class MusicPlayer(commands.Cog):
         `Command:` song-into()
         """
         if msg.voice_client is not None and msg.voice_client.is_playing() is True:
+            requester = msg.guild.get_member(self.player[msg.guild.id].track.requester)
             emb = discord.Embed(colour=self.random_color, title='Currently Playing',
-                                description=self.player[msg.guild.id]['player'].title)
+                                description=self.player[msg.guild.id].source.title)
             emb.set_footer(
-                text=f"{self.player[msg.guild.id]['author'].author.name}", icon_url=msg.author.avatar_url)
+                text=f"{requester.name if requester else 'unknown'}", icon_url=msg.author.avatar_url)
             emb.set_thumbnail(
-                url=self.player[msg.guild.id]['player'].thumbnail)
+                url=self.player[msg.guild.id].source.thumbnail)
             return await msg.send(embed=emb, delete_after=120)
 
         return await msg.send(f"**No songs currently playing**".title(), delete_after=30)
@@ -569,7 +1543,7 @@ class MusicPlayer(commands.Cog):
             return await channel.connect(), await msg.message.add_reaction(emoji='✅')
 
         else:
-            if msg.voice_client.is_playing() is False and not self.player[msg.guild.id]['queue']:
+            if msg.voice_client.is_playing() is False and not self.player[msg.guild.id].queue:
                 return await msg.author.voice.channel.connect(), await msg.message.add_reaction(emoji='✅')
 
     @join.before_invoke
@@ -601,40 +1575,152 @@ class MusicPlayer(commands.Cog):
         if msg.author.voice is not None:
             if msg.voice_client is not None:
                 if msg.voice_client.channel == msg.author.voice.channel and msg.voice_client.is_playing() is True:
-                    msg.voice_client.source.volume = vol
-                    self.player[msg.guild.id]['volume'] = vol
+                    player = self.player[msg.guild.id]
+                    player.volume = vol
+                    self.settings.set(msg.guild.id, volume=vol)
+                    if isinstance(msg.voice_client.source, discord.PCMVolumeTransformer):
+                        msg.voice_client.source.volume = vol
+                    else:
+                        # NOTE: volume is applied by FFmpeg, restart the song where it was with the new volume
+                        self.restart_song(msg.guild, player.source.position)
                     # if (msg.guild.id) in self.music:
                     #     self.music[str(msg.guild.id)]['vol']=vol
                     return await msg.message.add_reaction(emoji='✅')
 
         return await msg.send("**Please join the same voice channel as the bot to use the command**".title(), delete_after=30)
 
+    @commands.has_permissions(manage_channels=True)
+    @command(name='music-settings', aliases=['msettings'])
+    async def music_settings(self, msg, name: str = None, value: str = None):
+        """
+        Show or change the saved music settings of the server
+        `Ex:` s.music-settings max_queue 200
+        `Permission:` manage_channels
+        `Command:` music-settings(name:optional, value:optional)
+        """
+        settings = self.settings.get(msg.guild.id)
+        if name is None:
+            return await msg.send(wrap(*(f"{key}: {value}\n" for key, value in settings.items())))
+
+        if name not in setting_parsers or value is None:
+            return await msg.send(f"**Usage: music-settings <{'|'.join(setting_parsers)}> <value>**", delete_after=30)
+
+        try:
+            self.settings.set(msg.guild.id, **{name: setting_parsers[name](value)})
+        except ValueError:
+            return await msg.send(f"**Invalid value for {name}: {value}**", delete_after=30)
+        return await msg.message.add_reaction(emoji='✅')
+
+    @staticmethod
+    def fit_bitrate(duration, limit):
+        """
+        Get the highest bitrate (kbps) at which a song of the duration fits the upload limit
+        Returns None if the song doesn't fit even at the lowest bitrate
+        """
+        for bitrate in download_bitrates:
+            # NOTE: leave some room for the mp3 headers and tags
+            if duration * bitrate * 1000 / 8 * 1.02 < limit:
+                return bitrate
+        return None
+
     @commands.command(brief='Download songs', description='[prefix]download <video url or title> Downloads the song')
     async def download(self, ctx, *, song):
         """
-        Downloads the audio from given URL source and sends the audio source back to user to download from URL, the file will be removed from storage once sent.
+        Downloads the audio from given URL source and sends the audio source back to user to download from URL, the mp3 is converted at a bitrate which fits the upload limit.
         `Ex`: .download I'll Show you K/DA
         `Command`: download(url:required)
-        `NOTE`: file size can't exceed 8MB, otherwise it will fail to upload and cause error
+        `NOTE`: the song is rejected if it's too long to fit the upload limit even at low quality
+        """
+        message = await ctx.send(embed=discord.Embed(title="Preparing your download", description=f"Song: {song}"))
+        self.bot.loop.create_task(self.download_job(ctx, message, song))
+
+    async def convert_song(self, info, bitrate):
+        """
+        Get the mp3 file of a song at the bitrate, converting it if it wasn't yet
+        Users converting the same song at the same bitrate share the conversion, the file is pinned until released
+        Returns the key of the converted file
+        """
+        key = f"{cache_key(info)}-{bitrate}k.mp3"
+        if key in self.converted:
+            self.converted.acquire(key)
+            return key
+
+        async with self.converting.join(key, self._convert_song, info, bitrate, key):
+            self.converted.acquire(key)
+        return key
+
+    async def _convert_song(self, info, bitrate, key):
         """
+        Conversion job shared by `convert_song()`, the file is pinned until every user got it
+        """
+        song_data, data = await self.download_song(info['webpage_url'], priority=PRIORITY_BACKGROUND)
+        filename = self.converted.path(key)
         try:
-            with youtube_dl.YoutubeDL(ytdl_download_format_options) as ydl:
-                if "https://www.youtube.com/" in song:
-                    download = ydl.extract_info(song, True)
-                else:
-                    infosearched = ydl.extract_info(
-                        "ytsearch:"+song, False)
-                    download = ydl.extract_info(
-                        infosearched['entries'][0]['webpage_url'], True)
-                filename = ydl.prepare_filename(download)
-                embed = discord.Embed(
-                    title="Your download is ready", description="Please wait a moment while the file is beeing uploaded")
-                await ctx.send(embed=embed, delete_after=30)
-                await ctx.send(file=discord.File(filename))
-                os.remove(filename)
-        except (youtube_dl.utils.ExtractorError, youtube_dl.utils.DownloadError):
-            embed = discord.Embed(title="Song couldn't be downloaded", description=("Song:"+song))
-            await ctx.send(embed=embed)
+            # NOTE: unfinished files are swept once the bot restarts if the conversion never finishes
+            await scheduler.run(
+                'transcode', subprocess.run,
+                ['ffmpeg', '-y', '-loglevel', 'error', '-i', self.cache.path(cache_key(song_data)), '-vn', '-b:a', f'{bitrate}k', filename + '.part.mp3'],
+                check=True, priority=PRIORITY_BACKGROUND)
+            os.replace(filename + '.part.mp3', filename)
+        finally:
+            self.cache.release(cache_key(song_data))
+        return self.converted.add(info, key=key, pin=True)
+
+    async def download_job(self, ctx, message, song):
+        """
+        Background part of the download command, progress is shown by editing the message
+        Converted files are kept in the downloads folder and reused for the same song and bitrate until they're evicted
+        """
+        async def progress(title, description=f"Song: {song}"):
+            await message.edit(embed=discord.Embed(title=title, description=description))
+
+        try:
+            info, data = await Downloader.get_info(song)
+            if info['duration'] is None:
+                return await progress("Song couldn't be downloaded", "Songs without a known length can't be downloaded")
+
+            limit = ctx.guild.filesize_limit if ctx.guild else 8 * 1024**2
+            bitrate = self.fit_bitrate(info['duration'], limit)
+            if bitrate is None:
+                return await progress("Song couldn't be downloaded", f"**{info['title']}** is too long to fit the {limit // 1024**2}MB upload limit")
+
+            if f"{cache_key(info)}-{bitrate}k.mp3" not in self.converted:
+                await progress(f"Downloading and converting to {bitrate}kbps mp3", f"**{info['title']}**")
+            key = await self.convert_song(info, bitrate)
+
+            try:
+                await progress("Your download is ready", "Please wait a moment while the file is beeing uploaded")
+                title = re.sub(r'[^\w\- ]', '', info['title']) or 'song'
+                await ctx.send(file=discord.File(self.converted.path(key), filename=f"{title}.mp3"))
+            finally:
+                self.converted.release(key)
+            await message.delete()
+        except Exception as Error:
+            print(Error)  # NOTE: output back the error for later debugging
+            await progress("Song couldn't be downloaded")
+
+    @commands.command(name='media-jobs')
+    @commands.check(permissions.is_owner)
+    async def media_jobs(self, ctx):
+        """
+        Show how many youtube-dl and FFmpeg jobs are running and waiting
+        `Ex`: .media-jobs
+        `Command`: media-jobs()
+        """
+        lines = [
+            f"{name}: {stats['running']}/{stats['limit']} running, {stats['waiting']} waiting, {stats['total']} total\n"
+            f"    wait avg {stats['avg_wait']:.2f}s p50 {stats['p50_wait']:.2f}s max {stats['max_wait']:.2f}s\n"
+            for name, stats in scheduler.stats().items()
+        ]
+        lines += [
+            f"{name}: {flights.stats()['running']} in flight, {flights.stats()['started']} started, {flights.stats()['joined']} shared\n"
+            for name, flights in (('resolving', self.resolving), ('downloads', self.downloads), ('converting', self.converting))
+        ]
+        lines += [
+            f"{name}: {len(cache.entries)} files, {cache.size / 1024**2:.0f}/{cache.max_size / 1024**2:.0f}MB, {len(cache.pins)} pinned\n"
+            for name, cache in (('audio cache', self.cache), ('converted', self.converted))
+        ]
+        await ctx.send(wrap(*lines))
 
     @volume.error
     async def volume_error(self, msg,error):
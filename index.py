@@ -20,7 +20,7 @@ bot = Bot(
     owner_ids=config["owners"], command_attrs=dict(hidden=True), help_command=HelpFormat(),
     allowed_mentions=discord.AllowedMentions(roles=False, users=True, everyone=False),
     intents=discord.Intents(  # kwargs found at https://discordpy.readthedocs.io/en/latest/api.html?highlight=intents#discord.Intents
-        guilds=True, members=True, messages=True, reactions=True, presences=True
+        guilds=True, members=True, messages=True, reactions=True, presences=True, emojis=True
     )
 )
 @bot.event
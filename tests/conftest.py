@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# NOTE: the bot is ran from the root of the repo so tests import and read config.json the same way
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
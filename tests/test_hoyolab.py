@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+gs = pytest.importorskip('genshinstats')
+pytest.importorskip('discord')
+
+from benchmarks.hoyolab_ratelimit import FakeEndpoint
+from utils.hoyolab import CookiePool, HoyolabClient, HoyolabTimeout, load_cookies
+from utils.ratelimit import RequestScheduler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_default_config_has_no_cookies():
+    with open(os.path.join(ROOT, 'config.json')) as file:
+        config = json.load(file)
+
+    assert load_cookies(config.get('genshin_cookies') or [config.get('cookie_file', '')]) == []
+
+
+def test_client_without_cookies_skips_the_pool():
+    client = HoyolabClient.from_cookies([])
+    try:
+        assert client.pool is None
+        assert client.scheduler is not None
+
+        def get_user_stats(uid, **kwargs):
+            assert 'cookie' not in kwargs
+            return {'uid': uid}
+
+        assert asyncio.run(client.call(get_user_stats, 1)) == {'uid': 1}
+    finally:
+        client.close()
+
+
+def test_client_with_cookies_uses_the_pool():
+    client = HoyolabClient.from_cookies(load_cookies(['ltuid=1; ltoken=a']))
+    try:
+        assert client.pool is not None
+        assert client.pool.accounts[0].cookie == {'ltuid': '1', 'ltoken': 'a'}
+    finally:
+        client.close()
+
+
+def test_slow_calls_time_out():
+    client = HoyolabClient(timeout=0.05)
+    try:
+        def get_user_stats(uid):
+            time.sleep(0.2)
+
+        with pytest.raises(HoyolabTimeout) as info:
+            asyncio.run(client.call(get_user_stats, 1))
+        assert info.value.msg == "HoYoLAB took too long to respond, please try again later"
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize('accounts', [1, 2])
+def test_outage_sends_a_single_notice_per_channel(accounts):
+    endpoint = FakeEndpoint(rate=1, latency=0.01)
+    if accounts > 1:
+        cookies = [{'ltuid': str(i), 'ltoken': 'fake'} for i in range(accounts)]
+        pool = CookiePool(cookies, rate=50, burst=2, cooldown=0.05)
+        for account in pool.accounts:
+            account.scheduler.max_backoff = 0.05
+        client = HoyolabClient(pool=pool)
+    else:
+        client = HoyolabClient(scheduler=RequestScheduler(rate=50, burst=2, max_backoff=0.05))
+    notices = []
+
+    def notify(channel):
+        async def notify(position):
+            notices.append(channel)
+        return client.notice(channel, notify)
+
+    async def main():
+        return await asyncio.gather(
+            *(client.call(endpoint, uid, notify=notify(uid % 2)) for uid in range(10)), return_exceptions=True)
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        client.close()
+
+    # NOTE: requests keep waiting out the backoff and failing upstream, every channel only hears about it once
+    assert endpoint.calls['limited'] > 0
+    assert any(isinstance(result, gs.TooManyRequests) for result in results)
+    assert sorted(notices) == [0, 1]
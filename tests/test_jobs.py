@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('discord')
+
+from utils.jobs import Lane, SingleFlight
+
+
+def test_promoted_jobs_run_first():
+    async def main():
+        lane = Lane('download', 1)
+        order = []
+
+        async def job(name, priority, key=None):
+            await lane.acquire(priority, key)
+            order.append(name)
+            lane.release()
+
+        await lane.acquire()
+        tasks = [
+            asyncio.ensure_future(job('background', 3, 'song')),
+            asyncio.ensure_future(job('prefetch', 2)),
+        ]
+        await asyncio.sleep(0)
+        assert lane.promote('song', 0)
+        assert not lane.promote('song', 1)
+        assert not lane.promote('missing', 0)
+        lane.release()
+        await asyncio.gather(*tasks)
+        assert order == ['background', 'prefetch']
+
+    asyncio.run(main())
+
+
+def test_joined_flights_share_a_single_job():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key
+
+        results = await asyncio.gather(*(flights.run('song', fetch, 'song') for _ in range(3)))
+        assert results == ['song'] * 3
+        assert calls == ['song']
+        assert 'song' not in flights
+
+    asyncio.run(main())
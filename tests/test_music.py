@@ -0,0 +1,272 @@
+import asyncio
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+discord = pytest.importorskip('discord')
+pytest.importorskip('youtube_dl')
+
+from cogs import music
+from utils.audiocache import AudioCache, cache_key
+from utils.jobs import SingleFlight
+
+
+class FakeProcess:
+    """Stand-in for the FFmpeg process, only the arguments it was started with matter"""
+    stdout = None
+    pid = 0
+    returncode = 0
+
+    killed = False
+
+    def kill(self):
+        self.killed = True
+
+    def poll(self):
+        return 0
+
+    def wait(self, *args, **kwargs):
+        return 0
+
+    def communicate(self, *args, **kwargs):
+        return b'', b''
+
+
+@pytest.fixture
+def spawned(monkeypatch):
+    args = []
+
+    def spawn(self, command, **kwargs):
+        args.append(' '.join(command))
+        return FakeProcess()
+
+    monkeypatch.setattr(discord.FFmpegAudio, '_spawn_process', spawn)
+    return args
+
+
+def test_opus_at_full_volume_is_copied(spawned):
+    source = music.Downloader.create('song.webm', data={'acodec': 'opus'}, volume=1)
+    assert isinstance(source, music.OpusDownloader)
+    assert '-c:a copy' in spawned[0]
+
+
+def test_opus_with_volume_is_encoded(spawned):
+    music.Downloader.create('song.webm', data={'acodec': 'opus'}, volume=0.5)
+    assert '-c:a libopus' in spawned[0]
+    assert 'volume=0.5' in spawned[0]
+
+
+def voice_client(state):
+    """A real VoiceClient without a connection, `state` is 'stopped', 'playing' or 'paused'"""
+    voice = discord.VoiceClient.__new__(discord.VoiceClient)
+    voice._player = None
+    voice._connected = threading.Event()
+    voice.ws = voice.loop = None
+    if state != 'stopped':
+        source = music.Downloader.create('song.webm', data={'acodec': 'opus'})
+        voice._player = discord.player.AudioPlayer(source, voice)
+        if state == 'paused':
+            voice._player.pause(update_speaking=False)
+    return voice
+
+
+def music_player(state):
+    """Stand-in for the cog with a single server whose song is at 60s"""
+    guild = SimpleNamespace(id=1, voice_client=voice_client(state))
+    source = SimpleNamespace(data={'acodec': 'opus', 'duration': 300}, duration=300, position=60)
+    player = SimpleNamespace(name='song.webm', source=source, stream=False, volume=0.5)
+    cog = SimpleNamespace(player={guild.id: player}, parse_timestamp=music.MusicPlayer.parse_timestamp)
+    cog.restart_song = partial(music.MusicPlayer.restart_song, cog)
+    return cog, guild
+
+
+@pytest.mark.parametrize('state', ['playing', 'paused'])
+def test_restart_song_keeps_the_pause_state(spawned, state):
+    cog, guild = music_player(state)
+    old = guild.voice_client.source
+
+    assert cog.restart_song(guild, 90)
+    assert guild.voice_client.source is not old
+    assert guild.voice_client.source.position == 90
+    assert guild.voice_client.is_paused() == (state == 'paused')
+
+
+def test_seek_after_skip(spawned):
+    cog, guild = music_player('stopped')
+    sent = []
+
+    async def send(content, **kwargs):
+        sent.append(content)
+
+    channel = object()
+    guild.voice_client.channel = channel
+    msg = SimpleNamespace(
+        guild=guild, voice_client=guild.voice_client, send=send,
+        author=SimpleNamespace(voice=SimpleNamespace(channel=channel)),
+    )
+
+    assert not cog.restart_song(guild, 90)
+    asyncio.run(music.MusicPlayer.seek.callback(cog, msg, '1:30'))
+    assert sent == ["**No Audio Currently Playing**"]
+
+
+def test_servers_share_the_extraction_of_a_song(monkeypatch, tmp_path):
+    calls = []
+
+    def extract_info(self, url, download=True, **kwargs):
+        calls.append(url)
+        time.sleep(0.05)
+        return {'id': 'abc', 'extractor_key': 'Youtube', 'title': 'Song', 'url': 'https://media/abc'}
+
+    monkeypatch.setattr(music.youtube_dl.YoutubeDL, 'extract_info', extract_info)
+    cog = SimpleNamespace(cache=AudioCache(str(tmp_path)), resolving=SingleFlight(), stream_plays={})
+    cog.resolve_song = partial(music.MusicPlayer.resolve_song, cog)
+
+    async def main():
+        return await asyncio.gather(
+            music.MusicPlayer.prepare_song(cog, 'some song', stream=True),
+            cog.resolve_song('Some  Song', priority=music.PRIORITY_PREFETCH),
+        )
+
+    prepared, resolved = asyncio.run(main())
+    assert calls == ['some song']
+    assert prepared == (resolved[0], {'queue': []}, 'https://media/abc', True)
+    assert 'some song' not in cog.resolving
+
+
+def test_failed_playlist_marks_the_server_idle(monkeypatch):
+    def flat_playlist(url):
+        raise music.youtube_dl.DownloadError('playlist does not exist')
+
+    monkeypatch.setattr(music.Downloader, 'flat_playlist', staticmethod(flat_playlist))
+    cog = SimpleNamespace(player={1: music.GuildPlayer(1)}, idle={}, idle_heap=[])
+    cog.mark_busy = partial(music.MusicPlayer.mark_busy, cog)
+    cog.mark_idle = partial(music.MusicPlayer.mark_idle, cog)
+    request = music.Track(None, 'playlist', 'https://www.youtube.com/playlist?list=PL', 2, 3, None)
+
+    async def main():
+        cog.idle_wakeup = asyncio.Event()
+        with pytest.raises(music.youtube_dl.DownloadError):
+            await music.MusicPlayer.queue_playlist(cog, SimpleNamespace(id=1), request, play=True)
+
+    asyncio.run(main())
+    assert 1 in cog.idle
+
+
+@pytest.mark.parametrize('timestamp, seconds', [('90', 90), ('1:30', 90), ('1:02:03', 3723), ('0:05.5', 5.5)])
+def test_parse_timestamp(timestamp, seconds):
+    assert music.MusicPlayer.parse_timestamp(timestamp) == seconds
+
+
+@pytest.mark.parametrize('timestamp', ['nan', 'inf', '-inf', '1:nan', '-30', '1:-30', '-0:30', '1:2:3:4', '', '1:'])
+def test_parse_timestamp_rejects_invalid_values(timestamp):
+    with pytest.raises(ValueError):
+        music.MusicPlayer.parse_timestamp(timestamp)
+
+
+def test_restart_song_leaves_the_old_source_to_the_player(spawned):
+    cog, guild = music_player('playing')
+    process = guild.voice_client.source._process
+
+    assert cog.restart_song(guild, 90)
+    assert not process.killed
+    # NOTE: the player cleans up its current source once it's done with it
+    guild.voice_client.source.cleanup()
+    assert process.killed
+
+
+def test_downloads_are_written_to_the_cached_file(tmp_path):
+    cache = AudioCache(str(tmp_path / '100%'))
+    data = {'id': 'a/b:c?%(id)s', 'extractor_key': 'Generic', 'title': 'Song: "live"', 'ext': 'webm'}
+    key = cache_key(data)
+
+    ytdl = music.youtube_dl.YoutubeDL(dict(music.ytdl_format_options, outtmpl=cache.template(key)))
+    assert key == 'Generic-a_b_c___id_s'
+    assert ytdl.prepare_filename(data) == cache.path(key)
+
+
+def test_index_is_written_in_the_executor(tmp_path):
+    cache = AudioCache(str(tmp_path), delay=0)
+    (tmp_path / 'Youtube-abc').write_bytes(b'opus')
+
+    async def main():
+        cache.add({'id': 'abc', 'extractor_key': 'Youtube'}, query='some song')
+        assert not (tmp_path / 'index.json').exists()
+        while cache.written < cache.version or cache.pending is not None:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert AudioCache(str(tmp_path)).get('Some Song') == 'Youtube-abc'
+
+
+def test_song_plays_when_the_message_cant_be_sent(spawned, tmp_path):
+    played = []
+
+    async def send(**kwargs):
+        raise discord.Forbidden(SimpleNamespace(status=403, reason='Forbidden'), 'Missing Permissions')
+
+    voice = SimpleNamespace(play=lambda source, after: played.append(source))
+    guild = SimpleNamespace(id=1, voice_client=voice, get_member=lambda id: None)
+    bot = SimpleNamespace(get_channel=lambda id: SimpleNamespace(send=send))
+    cog = SimpleNamespace(
+        bot=bot, player={1: music.GuildPlayer(1)}, cache=AudioCache(str(tmp_path)), random_color=discord.Color.default(),
+        mark_busy=lambda guild_id: None, schedule_prefetch=lambda guild_id: None)
+    released = []
+    cog.cache.release = released.append
+    track = music.Track(None, 'song', 'https://youtu.be/abc', 2, 3, None)
+    prepared = ({'id': 'abc', 'extractor_key': 'Youtube', 'title': 'Song', 'acodec': 'opus'}, {'queue': []}, 'song.webm', False)
+
+    asyncio.run(music.MusicPlayer.start_song(cog, guild, track, prepared=prepared))
+    player = cog.player[1]
+    assert played == [player.source]
+    assert player.key == 'Youtube-abc'
+
+    asyncio.run(music.MusicPlayer.clear_data(cog, 1))
+    assert released == ['Youtube-abc']
+    assert player.key is None
+
+
+@pytest.mark.parametrize('data', [None, {'entries': [None]}])
+def test_unavailable_songs_raise_a_clear_error(data):
+    ytdl = SimpleNamespace(extract_info=lambda url, download: data)
+    with pytest.raises(music.youtube_dl.DownloadError, match='is unavailable'):
+        asyncio.run(music.Downloader.extract('https://youtu.be/private', ytdl, stream=True))
+
+
+def test_tracks_which_fail_are_skipped():
+    sent, played = [], []
+
+    async def send(content, **kwargs):
+        sent.append(content)
+
+    async def start_song(guild, track, prepared=None, **kwargs):
+        cog.mark_busy(guild.id)
+        if track.title == '[Private video]':
+            cog.mark_idle(guild.id)
+            raise music.youtube_dl.DownloadError(f"{track.url} is unavailable")
+        played.append(track.title)
+
+    async def take_prefetch(guild_id, track):
+        return None
+
+    guild = SimpleNamespace(id=1, voice_client=voice_client('stopped'))
+    bot = SimpleNamespace(get_channel=lambda id: SimpleNamespace(send=send))
+    cog = SimpleNamespace(
+        bot=bot, player={1: music.GuildPlayer(1)}, idle={}, idle_heap=[], start_song=start_song, take_prefetch=take_prefetch)
+    for name in ('mark_busy', 'mark_idle', 'is_idle'):
+        setattr(cog, name, partial(getattr(music.MusicPlayer, name), cog))
+    private = music.Track('a', '[Private video]', 'https://youtu.be/a', 2, 3, None)
+    cog.player[1].queue.extend([private, private._replace(title='Next song')])
+
+    async def main():
+        cog.idle_wakeup = asyncio.Event()
+        await music.MusicPlayer.play_track(cog, guild, private)
+
+    asyncio.run(main())
+    assert played == ['Next song']
+    assert sent == ["**Couldn't play [Private video], skipping it**"] * 2
+    assert not cog.player[1].queue
+    assert 1 not in cog.idle
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('discord')
+
+from utils.tools import Paginator
+
+
+def test_single_page_generator():
+    async def main():
+        paginator = await Paginator.create(page for page in ['only'])
+        assert paginator.curr == 'only'
+        assert await paginator.next() == 'only'
+        assert paginator.depleted
+
+    asyncio.run(main())
+
+
+def test_generator_pages_are_fetched_when_viewed():
+    fetched = []
+
+    def pages():
+        for page in range(3):
+            fetched.append(page)
+            yield page
+
+    async def main():
+        paginator = await Paginator.create(pages())
+        assert fetched == [0]
+        assert await paginator.next() == 1
+        assert await paginator.next() == 2
+        assert await paginator.next() == 0
+        assert paginator.prev() == 2
+
+    asyncio.run(main())
+
+
+def test_async_generator():
+    async def pages():
+        yield 'first'
+        yield 'second'
+
+    async def main():
+        paginator = await Paginator.create(pages())
+        assert paginator.curr == 'first'
+        assert await paginator.next() == 'second'
+
+    asyncio.run(main())
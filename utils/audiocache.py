@@ -0,0 +1,255 @@
+"""Persistent on-disk cache of downloaded audio files"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from .tools import to_thread
+
+# files which aren't in the index are only removed once they're this old, they may still be written
+STALE_AFTER = 3600
+
+# metadata saved with every cached file so a cache hit doesn't need youtube-dl
+KEPT_FIELDS = ('id', 'extractor_key', 'title', 'webpage_url', 'thumbnail', 'duration', 'view_count', 'acodec')
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes a search query so the same song always gets the same key
+
+    Urls are only stripped since video ids are case sensitive.
+    """
+    query = ' '.join(query.split())
+    if re.match(r'https?://', query):
+        return query
+    return query.lower()
+
+
+def cache_key(data: dict[str, Any]) -> str:
+    """Returns the key of a song made out of its extractor and video id
+
+    Characters which aren't safe in a file name are replaced since the key is also the name of the cached file.
+    """
+    extractor = data.get('extractor_key') or data.get('ie_key') or data.get('extractor')
+    return re.sub(r'[^\w.-]', '_', f"{extractor}-{data['id']}")
+
+
+class AudioCache:
+    """An LRU cache of audio files keyed by extractor and video id
+
+    The index is saved as json in the cache directory so the cache survives restarts.
+    Files which are currently being played are pinned and never evicted.
+    Files are also evicted while the disk has less than min_free bytes left.
+    The index is written in the executor `delay` seconds after a file was added so downloads never wait on the disk.
+    """
+    def __init__(
+        self,
+        directory: str = 'audio_cache',
+        max_size: int = 1024 * 1024**2,
+        max_aliases: int = 10000,
+        min_free: int = 0,
+        delay: float = 5,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_aliases = max_aliases
+        self.min_free = min_free
+        self.index_path = os.path.join(directory, 'index.json')
+        self.delay = delay
+        self.pending: Optional[asyncio.TimerHandle] = None
+        self.version = 0  # NOTE: writes started, an older index never overwrites a newer one
+        self.written = 0
+        self._lock = threading.Lock()
+
+        self.entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.aliases: OrderedDict[str, str] = OrderedDict()
+        self.pins: dict[str, int] = {}
+        self.size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} entries={len(self.entries)} size={self.size}>"
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def template(self, key: str) -> str:
+        """youtube-dl output template which downloads exactly into the cached file of the key
+
+        The fields of a template are sanitized by youtube-dl, so the path is used literally instead.
+        """
+        return self.path(key).replace('%', '%%')
+
+    def path(self, key: str) -> str:
+        """Returns the path of a cached file"""
+        return os.path.join(self.directory, key)
+
+    def load(self) -> None:
+        """Load the index from disk and remove stale files which aren't in it
+
+        Leftovers of crashes like partial downloads and unindexed files are removed this way.
+        """
+        try:
+            with open(self.index_path, encoding='utf8') as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {'entries': [], 'aliases': []}
+
+        # NOTE: entries are saved from the least to the most recently used
+        for key, entry in index['entries']:
+            try:
+                entry['size'] = os.path.getsize(self.path(key))
+            except OSError:
+                continue
+            self.entries[key] = entry
+            self.size += entry['size']
+
+        for query, key in index['aliases']:
+            if key in self.entries:
+                self.aliases[query] = key
+
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.name in self.entries or entry.name == 'index.json' or not entry.is_file():
+                continue
+            if now - entry.stat().st_mtime > STALE_AFTER:
+                os.remove(entry.path)
+
+        self.evict()
+
+    def save(self) -> None:
+        """Write the index to disk right away, blocking"""
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        self.version += 1
+        self._write(self._dump(), self.version)
+
+    def save_later(self) -> None:
+        """Write the index in the executor shortly after, several changes in a row cause a single write"""
+        if self.pending is None:
+            self.pending = asyncio.get_event_loop().call_later(self.delay, self._write_behind)
+
+    def _dump(self) -> str:
+        index = {'entries': list(self.entries.items()), 'aliases': list(self.aliases.items())}
+        return json.dumps(index)
+
+    def _write_behind(self) -> None:
+        """Write the index as it is now in the executor"""
+        self.pending = None
+        self.version += 1
+        asyncio.ensure_future(to_thread(self._write, self._dump(), self.version))
+
+    def _write(self, index: str, version: int) -> None:
+        """Write a dumped index unless a newer one was written already, blocking"""
+        with self._lock:
+            if version <= self.written:
+                return
+            try:
+                with open(self.index_path + '.tmp', 'w', encoding='utf8') as file:
+                    file.write(index)
+                os.replace(self.index_path + '.tmp', self.index_path)
+            except OSError as e:
+                print(f"Failed to save the index of {self.directory}: {e}")
+                return
+            self.written = version
+
+    def get(self, query: str) -> Optional[str]:
+        """Returns the key of a previously cached query"""
+        key = self.aliases.get(normalize_query(query))
+        if key not in self.entries:
+            return None
+        return key
+
+    def alias(self, query: str, key: str) -> None:
+        """Remember which song a query resolved to"""
+        query = normalize_query(query)
+        self.aliases[query] = key
+        self.aliases.move_to_end(query)
+        while len(self.aliases) > self.max_aliases:
+            self.aliases.popitem(last=False)
+
+    def add(self, data: dict[str, Any], query: str = None, pin: bool = False, key: str = None) -> str:
+        """Add a downloaded file to the cache and return its key
+
+        If pin is true the file is pinned before anything gets evicted.
+        The key is made out of the data unless given.
+        """
+        key = key or cache_key(data)
+        if key in self.entries:
+            self.size -= self.entries[key]['size']
+
+        size = os.path.getsize(self.path(key))
+        self.entries[key] = {
+            'data': {k: data.get(k) for k in KEPT_FIELDS},
+            'size': size,
+            'last_used': time.time(),
+        }
+        self.size += size
+        if query is not None:
+            self.alias(query, key)
+        if pin:
+            self.acquire(key)
+
+        self.evict()
+        self.save_later()
+        return key
+
+    def acquire(self, key: str) -> dict[str, Any]:
+        """Pin a cached file so it isn't evicted while it's played and return its data"""
+        entry = self.entries[key]
+        entry['last_used'] = time.time()
+        self.entries.move_to_end(key)
+        self.pins[key] = self.pins.get(key, 0) + 1
+        return entry['data']
+
+    def release(self, key: str) -> None:
+        """Unpin a cached file once it's not played anymore"""
+        if key not in self.pins:
+            return
+
+        self.pins[key] -= 1
+        if self.pins[key] <= 0:
+            del self.pins[key]
+            self.evict()
+
+    def excess(self) -> int:
+        """Returns how many bytes need to be freed to fit the max size and leave min_free bytes on the disk"""
+        excess = self.size - self.max_size
+        if self.min_free:
+            excess = max(excess, self.min_free - shutil.disk_usage(self.directory).free)
+        return excess
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the cache fits the max size and the disk has enough space"""
+        excess = self.excess()
+        evicted = set()
+        for key, entry in self.entries.items():
+            if excess <= 0:
+                break
+            if key in self.pins:
+                continue
+
+            evicted.add(key)
+            excess -= entry['size']
+            self.size -= entry['size']
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+        if not evicted:
+            return
+
+        for key in evicted:
+            del self.entries[key]
+        for query in [q for q, k in self.aliases.items() if k in evicted]:
+            del self.aliases[query]
@@ -1,6 +1,7 @@
 import discord
 
 from utils import permissions
+from utils.emojis import emoji_index
 from discord.ext.commands import AutoShardedBot, DefaultHelpCommand
 
 
@@ -15,6 +16,12 @@ class Bot(AutoShardedBot):
 
         await self.process_commands(msg)
 
+    async def on_guild_emojis_update(self, guild, before, after):
+        emoji_index.update(guild, after)
+
+    async def on_guild_remove(self, guild):
+        emoji_index.remove(guild)
+
 
 class HelpFormat(DefaultHelpCommand):
     def get_destination(self, no_pm: bool = False):
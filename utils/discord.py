@@ -8,6 +8,7 @@ from typing import TYPE_CHECKING, AsyncIterable, Iterable, Union
 import discord
 from discord.ext import commands
 
+from .emojis import emoji_index
 from .tools import Paginator
 
 
@@ -65,7 +66,7 @@ def get_emoji(name: str, guild: discord.Guild = None) -> discord.Emoji:
         from bot import bot
         guild = bot.get_guild(570841314200125460) # type: ignore
     
-    emoji = discord.utils.find(lambda e: e.name.lower() == name.lower(), guild.emojis)
+    emoji = emoji_index.get(guild, name)
     if emoji is None:
         warnings.warn(f"Couldn't find an emoji: {name}")
         return discord.PartialEmoji(name=":grey_question:") # type: ignore
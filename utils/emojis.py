@@ -0,0 +1,44 @@
+"""Process-wide index of guild emojis by name"""
+from __future__ import annotations
+
+from typing import *  # type: ignore
+
+import discord
+
+
+class EmojiIndex:
+    """Emojis of every guild keyed by their lowercase name
+
+    A guild is indexed the first time it's looked up, after that lookups are a single dict access.
+    The bot replaces the index of a guild when its emojis change and drops it when it leaves.
+    """
+    def __init__(self):
+        self.guilds: dict[int, dict[str, discord.Emoji]] = {}
+        self.builds = 0  # how many times a guild was indexed
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} guilds={len(self.guilds)} builds={self.builds}>"
+
+    def update(self, guild: discord.Guild, emojis: Sequence[discord.Emoji] = None) -> dict[str, discord.Emoji]:
+        """Index the emojis of a guild, defaults to the ones it currently has"""
+        # NOTE: the first emoji wins like it did with a linear search
+        index: dict[str, discord.Emoji] = {}
+        for emoji in reversed(guild.emojis if emojis is None else emojis):
+            index[emoji.name.lower()] = emoji
+        self.guilds[guild.id] = index
+        self.builds += 1
+        return index
+
+    def remove(self, guild: discord.Guild) -> None:
+        """Forget the emojis of a guild"""
+        self.guilds.pop(guild.id, None)
+
+    def get(self, guild: discord.Guild, name: str) -> Optional[discord.Emoji]:
+        """Returns the emoji of a guild with a name, case insensitive"""
+        index = self.guilds.get(guild.id)
+        if index is None:
+            index = self.update(guild)
+        return index.get(name.lower())
+
+
+emoji_index = EmojiIndex()
@@ -0,0 +1,326 @@
+"""Async facade over the blocking genshinstats api"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import *  # type: ignore
+
+import genshinstats as gs
+
+from .jobs import SingleFlight
+from .ratelimit import BACKGROUND, INTERACTIVE, RequestScheduler
+from .tieredcache import TieredCache
+
+T = TypeVar("T")
+
+# NOTE: seconds for which the responses of every endpoint are fresh
+DEFAULT_TTLS = {
+    'get_user_stats': 3600,
+    'get_spiral_abyss': 3600,
+    'get_characters': 3600,
+    'get_langs': 86400,
+}
+
+# NOTE: endpoints which don't need an account and don't take a cookie
+PUBLIC_ENDPOINTS = {'get_langs'}
+
+# NOTE: errors caused by the account rather than the requested user
+ACCOUNT_ERRORS = (gs.TooManyRequests, gs.NotLoggedIn)
+
+
+class HoyolabTimeout(gs.GenshinStatsException):
+    """HoYoLAB didn't respond in time"""
+    def __init__(self, msg: str = "HoYoLAB took too long to respond, please try again later") -> None:
+        super().__init__(msg)
+
+
+def load_cookies(sources: Iterable[Union[str, dict[str, str]]]) -> list[dict[str, str]]:
+    """Parse cookies given as dicts, cookie headers or files with a cookie header on every line"""
+    cookies = []
+    for source in sources:
+        if isinstance(source, dict):
+            cookies.append(source)
+            continue
+
+        if os.path.isfile(source):
+            with open(source) as file:
+                lines = [line.strip() for line in file]
+        else:
+            lines = [source.strip()]
+
+        for line in lines:
+            if line and not line.startswith('#'):
+                cookies.append(dict(pair.strip().split('=', 1) for pair in line.split(';') if '=' in pair))
+    return cookies
+
+
+class Account:
+    """A HoYoLAB account with its own rate limit"""
+    def __init__(self, cookie: dict[str, str], scheduler: RequestScheduler):
+        self.cookie = cookie
+        self.name = str(cookie.get('ltuid') or cookie.get('account_id') or '?')
+        self.scheduler = scheduler
+        self.requests = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} name={self.name!r} requests={self.requests} errors={self.errors}>"
+
+    @property
+    def cooldown(self) -> float:
+        """Seconds until the account can be used again"""
+        return max(0, self.cooldown_until - time.monotonic())
+
+    def budget(self) -> float:
+        """Requests the account can make right away, negative if others are already waiting for it"""
+        self.scheduler.bucket.refill()
+        return self.scheduler.bucket.tokens - sum(not i[3].done() for i in self.scheduler.waiting)
+
+
+class CookiePool:
+    """Spreads requests over several accounts by their remaining budget
+
+    Accounts which raise an account error are put on cooldown, if every account is on cooldown
+    the one which recovers the soonest is used.
+    """
+    def __init__(self, cookies: Iterable[dict[str, str]], rate: float = 1, burst: float = 5, cooldown: float = 3600):
+        self.accounts = [Account(cookie, RequestScheduler(rate, burst)) for cookie in cookies]
+        self.cooldown = cooldown
+        if not self.accounts:
+            raise ValueError("A cookie pool needs at least one cookie")
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} accounts={len(self.accounts)} available={sum(not i.cooldown for i in self.accounts)}>"
+
+    def pick(self) -> Account:
+        """Returns the available account with the most remaining budget"""
+        available = [account for account in self.accounts if not account.cooldown]
+        if not available:
+            return min(self.accounts, key=lambda account: account.cooldown_until)
+        return max(available, key=Account.budget)
+
+    def failed(self, account: Account) -> None:
+        """Put an account on cooldown"""
+        account.errors += 1
+        account.cooldown_until = time.monotonic() + self.cooldown
+        print(f"HoYoLAB account {account.name} is on cooldown for {self.cooldown}s")
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Returns the usage of every account"""
+        return {
+            account.name: {
+                'requests': account.requests,
+                'errors': account.errors,
+                'cooldown': account.cooldown,
+                'rate': account.scheduler.bucket.rate,
+                'waiting': account.scheduler.stats()['waiting'],
+            }
+            for account in self.accounts
+        }
+
+
+class HoyolabClient:
+    """Runs genshinstats in its own bounded executor with a timeout on every call
+
+    A slow response from mihoyo only ever holds up one of the client's threads, never the event loop
+    or the executor shared by the other cogs.
+    Concurrent calls of the same endpoint with the same arguments share a single request.
+
+    Responses are cached for the ttl of their endpoint, once they're older than that but not older than
+    `stale` more seconds they're still returned right away and refreshed in the background.
+
+    With a scheduler every request waits for its turn, background refreshes only go out once no command is waiting.
+    With a cookie pool every request is made with the account which has the most budget left, waiting for
+    that account's scheduler instead.
+    Requests which have to wait notify their caller at most once. Callbacks wrapped with `notice()` are
+    throttled per destination so an outage doesn't flood a channel.
+    """
+    def __init__(
+        self,
+        max_workers: int = 4,
+        timeout: float = 15,
+        cache: TieredCache = None,
+        ttls: dict[str, float] = {},
+        stale: float = 86400,
+        scheduler: RequestScheduler = None,
+        pool: CookiePool = None,
+        notice_interval: float = 60,
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hoyolab')
+        self.timeout = timeout
+        self.flights = SingleFlight()
+        self.requests: Counter[str] = Counter()  # upstream requests per endpoint
+        self.cache = cache
+        self.ttls = {**DEFAULT_TTLS, **ttls}
+        self.stale = stale
+        self.served: Counter[str] = Counter()  # lookups answered fresh, stale or by a request
+        self.scheduler = scheduler
+        self.pool = pool
+        self.notice_interval = notice_interval
+        self.noticed: dict[Hashable, float] = {}  # NOTE: destination -> time of its last notice since a request succeeded
+        if cache is not None:
+            cache.purge(max(self.ttls.values()) + stale)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} workers={self.executor._max_workers} timeout={self.timeout} requests={sum(self.requests.values())}>"
+
+    @classmethod
+    def from_cookies(
+        cls,
+        cookies: list[dict[str, str]],
+        rate: float = 1,
+        burst: float = 5,
+        cooldown: float = 3600,
+        **kwargs: Any,
+    ) -> HoyolabClient:
+        """Create a client with a pool of the cookies, without any cookies requests go through a single scheduler"""
+        if not cookies:
+            return cls(scheduler=RequestScheduler(rate, burst), **kwargs)
+        return cls(pool=CookiePool(cookies, rate, burst, cooldown), **kwargs)
+
+    async def call(
+        self,
+        func: Callable[..., T],
+        *args: Any,
+        priority: int = INTERACTIVE,
+        notify: Callable[[int], Awaitable[Any]] = None,
+        **kwargs: Any,
+    ) -> T:
+        """Run a genshinstats function once the scheduler allows it, raises HoyolabTimeout if it takes too long
+
+        Threads can't be interrupted so a timed out call keeps its thread until mihoyo responds.
+        """
+        account = None
+        scheduler = self.scheduler
+        while True:
+            if self.pool is not None and func.__name__ not in PUBLIC_ENDPOINTS:
+                account = self.pool.pick()
+                scheduler = account.scheduler
+                kwargs['cookie'] = account.cookie
+
+            if scheduler is not None:
+                await scheduler.acquire(priority, notify)
+                # NOTE: waiting again for another account doesn't repeat the notice
+                notify = None
+            # NOTE: the account may have been put on cooldown while the request waited for it
+            if account is None or not account.cooldown or self.pool.pick() is account:
+                break
+
+        self.requests[func.__name__] += 1
+        if account is not None:
+            account.requests += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise HoyolabTimeout() from None
+        except ACCOUNT_ERRORS as e:
+            if scheduler is not None and isinstance(e, gs.TooManyRequests):
+                scheduler.rate_limited()
+            if account is not None:
+                self.pool.failed(account)
+            raise
+
+        if scheduler is not None:
+            scheduler.succeeded()
+        self.noticed.clear()
+        return result
+
+    def notice(self, destination: Hashable, notify: Callable[[int], Awaitable[Any]]) -> Callable[[int], Awaitable[Any]]:
+        """Wrap a notify callback so a destination gets one notice every `notice_interval` seconds until a request succeeds"""
+        async def throttled(position: int) -> None:
+            now = time.monotonic()
+            if destination in self.noticed and now - self.noticed[destination] < self.notice_interval:
+                return
+            self.noticed[destination] = now
+            await notify(position)
+        return throttled
+
+    async def fetch(self, endpoint: str, *args: Any, notify: Callable[[int], Awaitable[Any]] = None, **kwargs: Any) -> Any:
+        """Call a genshinstats endpoint, joining the request in flight for the same arguments if there is one
+
+        Cached responses are returned if they're fresh or stale, stale ones are refreshed in the background.
+        If the request has to wait for the scheduler notify is called with its position in the queue.
+        """
+        key = json.dumps([endpoint, args, sorted(kwargs.items())])
+        entry = await self.cache.get(key) if self.cache is not None else None
+        if entry is not None:
+            tier, stored, value = entry
+            age = time.time() - stored
+            if age < self.ttls.get(endpoint, 3600):
+                self.served['fresh'] += 1
+                return value
+            if age < self.ttls.get(endpoint, 3600) + self.stale:
+                self.served['stale'] += 1
+                if key not in self.flights:
+                    asyncio.ensure_future(self._revalidate(key, endpoint, args, kwargs))
+                return value
+
+        self.served['request'] += 1
+        return await self.flights.run(key, self._request, key, endpoint, args, kwargs, INTERACTIVE, notify)
+
+    async def _request(
+        self,
+        key: str,
+        endpoint: str,
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        priority: int = INTERACTIVE,
+        notify: Callable[[int], Awaitable[Any]] = None,
+    ) -> Any:
+        """Request an endpoint and cache the response"""
+        value = await self.call(getattr(gs, endpoint), *args, priority=priority, notify=notify, **kwargs)
+        if self.cache is not None:
+            await self.cache.set(key, value)
+        return value
+
+    async def _revalidate(self, key: str, endpoint: str, args: tuple[Any, ...], kwargs: dict[str, Any]) -> None:
+        """Refresh a stale response in the background"""
+        try:
+            await self.flights.run(key, self._request, key, endpoint, args, kwargs, BACKGROUND)
+        except Exception as e:
+            print(f"Failed to refresh {endpoint}{args}: {e}")
+
+    def stats(self) -> dict[str, Any]:
+        """Returns how lookups were answered, the hit rate of every cache tier, the upstream requests, the scheduler and the accounts"""
+        return {
+            'served': dict(self.served),
+            'tiers': self.cache.stats() if self.cache is not None else {},
+            'requests': dict(self.requests),
+            'scheduler': self.scheduler.stats() if self.scheduler is not None else {},
+            'accounts': self.pool.stats() if self.pool is not None else {},
+        }
+
+    async def get_user_stats(self, uid: int, notify: Callable[[int], Awaitable[Any]] = None) -> dict[str, Any]:
+        """Returns the stats, explorations, teapots and characters of a user"""
+        return await self.fetch('get_user_stats', uid, notify=notify)
+
+    async def get_spiral_abyss(self, uid: int, previous: bool = False, notify: Callable[[int], Awaitable[Any]] = None) -> dict[str, Any]:
+        """Returns the spiral abyss runs of a user in the current or previous season"""
+        return await self.fetch('get_spiral_abyss', uid, previous, notify=notify)
+
+    async def get_abyss_seasons(self, uid: int, notify: Callable[[int], Awaitable[Any]] = None) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Returns the spiral abyss runs of a user in the current and previous season, fetched at the same time"""
+        # NOTE: only the first season reports its queue position, both would announce the same wait
+        current, previous = await asyncio.gather(self.get_spiral_abyss(uid, notify=notify), self.get_spiral_abyss(uid, True))
+        return current, previous
+
+    async def get_characters(self, uid: int, lang: str = 'en-us', notify: Callable[[int], Awaitable[Any]] = None) -> list[dict[str, Any]]:
+        """Returns the characters of a user with their weapons and artifacts"""
+        return await self.fetch('get_characters', uid, lang=lang, notify=notify)
+
+    async def get_langs(self, notify: Callable[[int], Awaitable[Any]] = None) -> dict[str, str]:
+        """Returns the languages supported by the api"""
+        return await self.fetch('get_langs', notify=notify)
+
+    def close(self) -> None:
+        """Stop the executor without waiting for the calls still running and close the cache"""
+        self.executor.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,190 @@
+"""Bounded job scheduler with priority admission"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import *  # type: ignore
+
+from .tools import to_thread
+
+T = TypeVar("T")
+
+
+class Lane:
+    """A group of jobs sharing a concurrency limit
+
+    Waiting jobs are admitted by priority (lower is sooner) and then in order of arrival.
+    """
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.running = 0
+        self.waiting: list[tuple[int, int, float, asyncio.Future[None], Optional[Hashable]]] = []
+        self.counter = itertools.count()
+        self.total = 0
+        self.waits: deque[float] = deque(maxlen=256)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} name={self.name!r} running={self.running}/{self.limit} waiting={len(self.waiting)}>"
+
+    async def acquire(self, priority: int = 0, key: Hashable = None) -> None:
+        """Wait until the job can run, the key allows promoting the job while it waits"""
+        self.total += 1
+        if self.running < self.limit and not self.waiting:
+            self.running += 1
+            self.waits.append(0)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), time.monotonic(), future, key))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # NOTE: the slot was handed over right before the cancel, pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Hand the slot over to the next waiting job or free it"""
+        while self.waiting:
+            priority, count, start, future, key = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self.waits.append(time.monotonic() - start)
+            future.set_result(None)
+            return
+
+        self.running -= 1
+
+    def promote(self, key: Hashable, priority: int) -> bool:
+        """Raise the priority of the waiting job with the key, returns whether one was promoted"""
+        for i, entry in enumerate(self.waiting):
+            if key is not None and entry[4] == key and priority < entry[0] and not entry[3].done():
+                self.waiting[i] = (priority, *entry[1:])
+                heapq.heapify(self.waiting)
+                return True
+        return False
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the queue depth and wait times of the lane"""
+        waits = sorted(self.waits)
+        return {
+            'running': self.running,
+            'limit': self.limit,
+            'waiting': sum(not i[3].done() for i in self.waiting),
+            'total': self.total,
+            'avg_wait': sum(waits) / len(waits) if waits else 0,
+            'p50_wait': waits[len(waits) // 2] if waits else 0,
+            'max_wait': waits[-1] if waits else 0,
+        }
+
+
+class JobScheduler:
+    """Runs blocking jobs in the executor with a separate concurrency limit per lane
+
+    >>> scheduler = JobScheduler(download=4, transcode=2)
+    >>> await scheduler.run('download', func, arg, priority=0)
+    """
+    def __init__(self, **limits: int):
+        self.lanes = {name: Lane(name, limit) for name, limit in limits.items()}
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} lanes={list(self.lanes.values())}>"
+
+    async def run(self, lane: str, func: Callable[..., T], *args: Any, priority: int = 0, key: Hashable = None, **kwargs: Any) -> T:
+        """Run a blocking function in the executor once the lane has a free slot
+
+        Threads can't be interrupted so the slot is only freed once the function returns, even if cancelled.
+        A job with a key can be moved ahead with `promote()` while it waits for its slot.
+        """
+        await self.lanes[lane].acquire(priority, key)
+        future = to_thread(func, *args, **kwargs)
+        future.add_done_callback(lambda f: self.lanes[lane].release())
+        return await asyncio.shield(future)
+
+    def promote(self, lane: str, key: Hashable, priority: int) -> bool:
+        """Raise the priority of a job waiting in the lane, jobs which already run or have a higher priority are left alone"""
+        return self.lanes[lane].promote(key, priority)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Returns the stats of every lane"""
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+class Flight:
+    """A job shared by every caller asking for the same key"""
+    __slots__ = ('future', 'refs')
+
+    def __init__(self, future: asyncio.Future[Any]):
+        self.future = future
+        self.refs = 0
+
+
+class SingleFlight:
+    """Runs a job only once for every caller asking for the same key at the same time
+
+    Callers hold a reference to the result while they use it, `cleanup` is called with the result
+    once the last one is done with it.
+
+    >>> downloads = SingleFlight(cleanup=release)
+    >>> async with downloads.join(key, download, url) as result:
+    ...     acquire(result)
+    """
+    def __init__(self, cleanup: Callable[[Any], Any] = None):
+        self.cleanup = cleanup
+        self.flights: dict[Hashable, Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} flights={len(self.flights)} started={self.started} joined={self.joined}>"
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.flights
+
+    @asynccontextmanager
+    async def join(self, key: Hashable, func: Callable[..., Awaitable[T]], /, *args: Any, **kwargs: Any) -> AsyncIterator[T]:
+        """Start the job or join the one in flight and hold a reference to its result for the duration of the block
+
+        Cancelling a caller doesn't cancel the job, it keeps running for the others.
+        The key and func are positional-only so they don't clash with the keyword arguments of the job.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(func(*args, **kwargs)))
+            flight.future.add_done_callback(lambda f: self._finish(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        flight.refs += 1
+        try:
+            yield await asyncio.shield(flight.future)
+        finally:
+            flight.refs -= 1
+            self._finish(key, flight)
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable[T]], /, *args: Any, **kwargs: Any) -> T:
+        """Start the job or join the one in flight and return its result"""
+        async with self.join(key, func, *args, **kwargs) as result:
+            return result
+
+    def _finish(self, key: Hashable, flight: Flight) -> None:
+        """Forget the job once it's done and nobody holds its result anymore"""
+        if flight.refs or not flight.future.done() or self.flights.get(key) is not flight:
+            return
+
+        del self.flights[key]
+        if flight.future.cancelled() or flight.future.exception() is not None:
+            return
+        if self.cleanup is not None:
+            self.cleanup(flight.future.result())
+
+    def stats(self) -> dict[str, int]:
+        """Returns how many jobs are in flight and how many calls were shared"""
+        return {'running': len(self.flights), 'started': self.started, 'joined': self.joined}
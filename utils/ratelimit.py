@@ -0,0 +1,133 @@
+"""Token bucket request scheduler with priority lanes and adaptive backoff"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+from typing import *  # type: ignore
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """Refills `rate` tokens every second up to `capacity`"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} rate={self.rate} tokens={self.tokens:.2f}/{self.capacity}>"
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self.refill()
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """Hands out permission to make requests at a steady rate
+
+    Waiting requests are admitted by priority (lower is sooner) and then in order of arrival.
+    When the api reports a rate limit the rate is halved and every request is paused for a backoff
+    which doubles with every consecutive limit, successful requests slowly bring the rate back up.
+    """
+    def __init__(self, rate: float = 1, burst: float = 5, max_backoff: float = 300):
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate, burst)
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.paused_until = 0.0
+        self.waiting: list[tuple[int, int, float, asyncio.Future[None]]] = []
+        self.counter = itertools.count()
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.granted: Counter[int] = Counter()  # requests let through per priority
+        self.limited = 0  # rate limits reported by the api
+        self.waits: deque[float] = deque(maxlen=256)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} rate={self.bucket.rate:.2f}/{self.max_rate} waiting={len(self.waiting)} backoff={self.backoff}>"
+
+    def _ready(self) -> float:
+        """Seconds until the next request may be made"""
+        return max(self.paused_until - time.monotonic(), self.bucket.delay())
+
+    def position(self, future: asyncio.Future[None]) -> int:
+        """Returns the 1-based position of a waiting request"""
+        entry = next(i for i in self.waiting if i[3] is future)
+        return 1 + sum(i[:2] < entry[:2] and not i[3].done() for i in self.waiting)
+
+    async def acquire(self, priority: int = INTERACTIVE, notify: Callable[[int], Awaitable[Any]] = None) -> None:
+        """Wait until a request may be made, notify is called with the queue position if it has to wait"""
+        if not self.waiting and self._ready() <= 0:
+            self.bucket.take()
+            self.granted[priority] += 1
+            self.waits.append(0)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), time.monotonic(), future))
+        if notify is not None:
+            asyncio.ensure_future(notify(self.position(future)))
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        """Let the waiting requests through once tokens become available"""
+        try:
+            while self.waiting:
+                delay = self._ready()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                priority, count, start, future = heapq.heappop(self.waiting)
+                if future.done():
+                    continue
+                self.bucket.take()
+                self.granted[priority] += 1
+                self.waits.append(time.monotonic() - start)
+                future.set_result(None)
+        finally:
+            self.dispatcher = None
+
+    def rate_limited(self) -> None:
+        """Slow down after the api reported a rate limit"""
+        self.limited += 1
+        self.backoff = min(self.max_backoff, max(1 / self.max_rate, self.backoff * 2))
+        self.paused_until = time.monotonic() + self.backoff
+        self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+        self.bucket.tokens = min(self.bucket.tokens, 0)
+
+    def succeeded(self) -> None:
+        """Recover the rate after a request went through"""
+        self.backoff = 0
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 16)
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the current rate, queue depth and wait times"""
+        waits = sorted(self.waits)
+        return {
+            'rate': self.bucket.rate,
+            'max_rate': self.max_rate,
+            'waiting': sum(not i[3].done() for i in self.waiting),
+            'granted': dict(self.granted),
+            'limited': self.limited,
+            'backoff': max(0, self.paused_until - time.monotonic()),
+            'p50_wait': waits[len(waits) // 2] if waits else 0,
+            'max_wait': waits[-1] if waits else 0,
+        }
@@ -0,0 +1,88 @@
+"""Per-guild settings kept in sqlite with a read cache and write-behind flushes"""
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import threading
+from typing import *  # type: ignore
+
+from .tools import to_thread
+
+
+class GuildSettings:
+    """Settings of every guild stored in a sqlite database in WAL mode
+
+    Every row is read once when created and then served from memory.
+    Changes are written in batches `delay` seconds after the first unsaved one so rapid changes cause a single write.
+    """
+    def __init__(self, path: str, table: str, defaults: dict[str, Any], delay: float = 5):
+        self.path = path
+        self.table = table
+        self.defaults = defaults
+        self.delay = delay
+        self.cache: dict[int, dict[str, Any]] = {}
+        self.dirty: set[int] = set()
+        self.pending: Optional[asyncio.TimerHandle] = None
+        self.writes = 0
+        self._lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (guild_id INTEGER PRIMARY KEY, settings TEXT NOT NULL)")
+        self.connection.commit()
+        self.load()
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} path={self.path!r} guilds={len(self.cache)} dirty={len(self.dirty)} writes={self.writes}>"
+
+    def load(self) -> None:
+        """Read every guild's settings into memory"""
+        for guild_id, settings in self.connection.execute(f"SELECT guild_id, settings FROM {self.table}"):
+            self.cache[guild_id] = json.loads(settings)
+
+    def get(self, guild_id: int) -> dict[str, Any]:
+        """Returns the settings of a guild, never touches the disk"""
+        return {**self.defaults, **self.cache.get(guild_id, {})}
+
+    def set(self, guild_id: int, **settings: Any) -> None:
+        """Change the settings of a guild, they're written to disk shortly after"""
+        self.cache.setdefault(guild_id, {}).update(settings)
+        self.dirty.add(guild_id)
+        if self.pending is None:
+            self.pending = asyncio.get_event_loop().call_later(self.delay, self._write_behind)
+
+    def _take_dirty(self) -> list[tuple[int, str]]:
+        """Returns the rows of the changed guilds and marks them as saved"""
+        rows = [(guild_id, json.dumps(self.cache[guild_id])) for guild_id in self.dirty]
+        self.dirty.clear()
+        return rows
+
+    def _write_behind(self) -> None:
+        """Write the changed guilds in the executor"""
+        self.pending = None
+        rows = self._take_dirty()
+        if rows:
+            asyncio.ensure_future(to_thread(self._write, rows))
+
+    def _write(self, rows: list[tuple[int, str]]) -> None:
+        """Write rows in a single transaction, blocking"""
+        try:
+            with self._lock, self.connection:
+                self.connection.executemany(f"INSERT OR REPLACE INTO {self.table} (guild_id, settings) VALUES (?, ?)", rows)
+            self.writes += 1
+        except sqlite3.Error as e:
+            print(f"Failed to save {len(rows)} guild settings: {e}")
+
+    def close(self) -> None:
+        """Write the unsaved changes right away and close the database"""
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+        rows = self._take_dirty()
+        if rows:
+            self._write(rows)
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,94 @@
+"""Two tier cache of json values, a bounded in-memory LRU in front of sqlite"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import *  # type: ignore
+
+from .tools import to_thread
+
+
+class TieredCache:
+    """A bounded LRU kept in memory in front of a sqlite table which survives restarts
+
+    Entries keep the time they were stored at so callers can decide how fresh they need them to be.
+    Values read from sqlite are promoted to the memory tier.
+    """
+    def __init__(self, path: str, max_memory: int = 4096, table: str = 'cache'):
+        self.path = path
+        self.max_memory = max_memory
+        self.table = table
+        self.memory: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits: Counter[str] = Counter()  # lookups per tier which found the key: memory, disk or miss
+        self._lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, stored REAL NOT NULL, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} path={self.path!r} memory={len(self.memory)}/{self.max_memory}>"
+
+    def _remember(self, key: str, entry: tuple[float, Any]) -> None:
+        """Put an entry in the memory tier and evict the least recently used ones"""
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[tuple[float, Any]]:
+        """Read an entry from sqlite, blocking"""
+        with self._lock:
+            row = self.connection.execute(f"SELECT stored, value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _write(self, key: str, entry: tuple[float, Any]) -> None:
+        """Write an entry to sqlite, blocking"""
+        with self._lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, stored, value) VALUES (?, ?, ?)",
+                (key, entry[0], json.dumps(entry[1])))
+
+    async def get(self, key: str) -> Optional[tuple[str, float, Any]]:
+        """Returns the tier the entry was found in, the time it was stored at and its value"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits['memory'] += 1
+            return ('memory', *self.memory[key])
+
+        entry = await to_thread(self._read, key)
+        if entry is None:
+            self.hits['miss'] += 1
+            return None
+
+        self.hits['disk'] += 1
+        self._remember(key, entry)
+        return ('disk', *entry)
+
+    async def set(self, key: str, value: Any) -> None:
+        """Store a value in both tiers"""
+        entry = (time.time(), value)
+        self._remember(key, entry)
+        await to_thread(self._write, key, entry)
+
+    def purge(self, max_age: float) -> int:
+        """Remove the entries older than max_age from sqlite, returns how many were removed"""
+        with self._lock, self.connection:
+            return self.connection.execute(f"DELETE FROM {self.table} WHERE stored < ?", (time.time() - max_age,)).rowcount
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the hit rate of every tier"""
+        total = sum(self.hits.values())
+        return {tier: (self.hits[tier], self.hits[tier] / total if total else 0) for tier in ('memory', 'disk', 'miss')}
+
+    def close(self) -> None:
+        """Close the database"""
+        with self._lock:
+            self.connection.close()
@@ -132,7 +132,9 @@ class Paginator(Generic[T]):
             return cls(iterable)
         
         self = cls(iterable)
-        self.saved.append(await maybe_anext(self.it))
+        if not self.saved:
+            # NOTE: sync iterables already got their first page, getting another would fail for single page iterables
+            self.saved.append(await maybe_anext(self.it))
         return self
     
     def __repr__(self) -> str:
@@ -0,0 +1,146 @@
+"""Shared YouTube Data API client with cached searches"""
+from __future__ import annotations
+
+import re
+import threading
+import time
+from typing import *  # type: ignore
+
+from cachetools import TTLCache
+
+from .formatting import grouper
+from .tools import to_thread
+
+# NOTE: quota units of each request, the default daily quota is 10000 units
+SEARCH_COST = 100
+VIDEOS_COST = 1
+
+
+def parse_duration(duration: str) -> Optional[int]:
+    """Parses an ISO 8601 duration like PT1H2M3S into seconds"""
+    match = re.fullmatch(r'P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', duration or '')
+    if match is None:
+        return None
+    d, h, m, s = (int(i or 0) for i in match.groups())
+    return ((d * 24 + h) * 60 + m) * 60 + s
+
+
+class YouTubeAPI:
+    """A YouTube Data API client which is built only once per process
+
+    Search results and video info are kept in TTL caches and the quota used today is tracked
+    so callers can fall back to youtube-dl once it runs out.
+    """
+    def __init__(self, api_key: str, daily_quota: int = 10000, ttl: int = 6 * 3600):
+        self.api_key = api_key
+        self.daily_quota = daily_quota
+        self.searches: TTLCache[str, list[str]] = TTLCache(4096, ttl)
+        self.videos: TTLCache[str, dict[str, Any]] = TTLCache(16384, ttl)
+        # NOTE: ids the api didn't return, like private or deleted videos of a playlist
+        self.unavailable: TTLCache[str, bool] = TTLCache(16384, ttl)
+        self.used = 0
+        self.day = self._today()
+        self._client = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} used={self.used}/{self.daily_quota} searches={len(self.searches)} videos={len(self.videos)}>"
+
+    @staticmethod
+    def _today() -> int:
+        """The quota resets at midnight pacific time"""
+        return int((time.time() - 8 * 3600) // 86400)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def client(self) -> Any:
+        """The discovery document is fetched and parsed only once, blocking"""
+        with self._lock:
+            if self._client is None:
+                from googleapiclient.discovery import build
+                self._client = build('youtube', 'v3', developerKey=self.api_key, cache_discovery=False)
+            return self._client
+
+    def _http(self) -> Any:
+        """httplib2 isn't thread safe so every executor thread gets its own connection"""
+        if not hasattr(self._local, 'http'):
+            from googleapiclient.http import build_http
+            self._local.http = build_http()
+        return self._local.http
+
+    def _spend(self, cost: int) -> bool:
+        """Reserve quota for a request, returns False if there's not enough left today"""
+        if self._today() != self.day:
+            self.day = self._today()
+            self.used = 0
+        if self.used + cost > self.daily_quota:
+            return False
+        self.used += cost
+        return True
+
+    def _execute(self, make_request: Callable[[Any], Any]) -> dict[str, Any]:
+        """Builds the request with the shared client and executes it, must be ran in an executor"""
+        from googleapiclient.errors import HttpError
+        try:
+            return make_request(self.client).execute(http=self._http())
+        except HttpError as e:
+            if e.resp.status == 403:
+                # NOTE: quota exceeded, don't try again until it resets
+                self.used = self.daily_quota
+            raise
+
+    async def search(self, query: str) -> Optional[list[str]]:
+        """Returns the ids of the videos found by a search or None if the api can't be used"""
+        query = ' '.join(query.lower().split())
+        if query in self.searches:
+            return self.searches[query]
+        if not self.enabled or not self._spend(SEARCH_COST):
+            return None
+
+        data = await to_thread(self._execute, lambda client: client.search().list(
+            part='id', q=query, type='video', maxResults=5))
+        ids = [item['id']['videoId'] for item in data.get('items', [])]
+        self.searches[query] = ids
+        return ids
+
+    async def get_videos(self, ids: Iterable[str]) -> dict[str, dict[str, Any]]:
+        """Returns the info of the videos, up to 50 uncached videos are fetched per request
+
+        Videos the api doesn't return are remembered in `unavailable` and not requested again.
+        """
+        ids = list(ids)
+        missing = [i for i in ids if i not in self.videos and i not in self.unavailable]
+        for chunk in grouper(missing, 50):
+            if not self.enabled or not self._spend(VIDEOS_COST):
+                break
+
+            data = await to_thread(self._execute, lambda client: client.videos().list(
+                part='snippet,contentDetails', id=','.join(chunk), maxResults=50))
+            for item in data.get('items', []):
+                self.videos[item['id']] = {
+                    'id': item['id'],
+                    'extractor_key': 'Youtube',
+                    'title': item['snippet']['title'],
+                    'webpage_url': f"https://www.youtube.com/watch?v={item['id']}",
+                    'thumbnail': item['snippet'].get('thumbnails', {}).get('high', {}).get('url'),
+                    'duration': parse_duration(item['contentDetails'].get('duration')),
+                }
+            for i in chunk:
+                if i not in self.videos:
+                    self.unavailable[i] = True
+
+        return {i: self.videos[i] for i in ids if i in self.videos}
+
+
+_clients: dict[str, YouTubeAPI] = {}
+
+
+def get_client(api_key: str) -> YouTubeAPI:
+    """Returns the process wide client for the api key, kept when cogs are reloaded"""
+    if api_key not in _clients:
+        _clients[api_key] = YouTubeAPI(api_key)
+    return _clients[api_key]